@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=utf-8:noet
+
+##  Copyright 2022 Bashclub
+##  BSD-2-Clause
+##
+##  Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+##
+##  1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+##
+##  2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+## THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS
+## BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE
+## GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+## LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+## OPNsense CheckMK Agent benchmark
+## generates scaled FreeBSD/OPNsense fixtures in the --record/--replay layout of the agent
+## and replays them through checkmk_replay on any machine
+##
+## python3 benchmark.py > bench_output.txt
+## python3 benchmark.py --interfaces 1000 --processes 20000 --sections netctr,ps
+## python3 benchmark.py --agent /tmp/agent_old.py ## compare with another version (needs checkmk_replay)
+##
+## netctr/ps before the parser rework (first version with checkmk_replay):
+## git show 7f2ba49:opnsense_checkmk_agent.py > /tmp/agent_037.py
+## python3 benchmark.py --agent /tmp/agent_037.py --interfaces 1000 --processes 20000 --rounds 10 --sections netctr,ps,net
+## python3 benchmark.py --interfaces 1000 --processes 20000 --rounds 10 --sections netctr,ps,net
+## python3 benchmark.py --import-time --rounds 20 ## startup cost of the module, median import time and maxrss
+## python3 benchmark.py --fixtures /tmp/recording ## keep the generated fixtures or replay a real --record directory
+## ipsec_vici and ntp_control are served by a fake charon.vici unix socket and a mode 6 udp stub on 127.0.0.1
+##
+
+import sys
+import os
+import time
+import json
+import shutil
+import tempfile
+import pwd
+import socket
+import struct
+import threading
+import subprocess
+import importlib.util
+import tracemalloc
+
+AGENT = os.path.join(os.path.dirname(os.path.abspath(__file__)),"opnsense_checkmk_agent.py")
+SECTIONS = ("net","netctr","ps","mem","dhcp","wireguard","ntp","label","cpu","df","mounts","tcp","ipsec_vici","ntp_control","config_reader","gateway")
+
+def load_agent(path):
+    _spec = importlib.util.spec_from_file_location("opnsense_checkmk_agent",path)
+    _agent = importlib.util.module_from_spec(_spec)
+    _spec.loader.exec_module(_agent)
+    return _agent
+
+def generate_fixtures(agent,directory,interfaces=1000,leases=10000,peers=5000,processes=20000):
+    _replay = agent.checkmk_replay(directory,record=True)
+    def _file(path,data):
+        _path = os.path.join(directory,"files",path.lstrip(os.path.sep))
+        os.makedirs(os.path.dirname(_path),exist_ok=True)
+        with open(_path,"w") as _f:
+            _f.write(data)
+    _now = int(time.time())
+
+    _ifconfig = []
+    _netstat_link = ["Name    Mtu Network       Address              Ipkts Ierrs Idrop     Ibytes    Opkts Oerrs     Obytes  Coll  Drop"]
+    _netstat_inb = ["Name    Mtu Network       Address              Ipkts Ierrs Idrop     Ibytes    Opkts Oerrs     Obytes  Coll"]
+    _config_interfaces = []
+    for _num in range(interfaces):
+        _if = f"igb0_vlan{_num + 1}"
+        _mac = "02:00:00:{0:02x}:{1:02x}:{2:02x}".format(_num >> 16 & 0xff,_num >> 8 & 0xff,_num & 0xff)
+        _ip = "10.{0}.{1}.1".format(_num >> 8 & 0xff,_num & 0xff)
+        _ifconfig.append("\n".join([
+            f"{_if}: flags=8943<UP,BROADCAST,RUNNING,PROMISC,SIMPLEX,MULTICAST> metric 0 mtu 1500",
+            f"\tdescription: VLAN{_num + 1} (opt{_num + 1})",
+            "\toptions=4000000<NOMAP>",
+            f"\tether {_mac}",
+            f"\tinet {_ip}/24 broadcast 10.{_num >> 8 & 0xff}.{_num & 0xff}.255",
+            f"\tinet6 fe80::ff:fe00:{_num & 0xffff:x}%{_if}/64 scopeid 0x{_num + 3:x}",
+            "\tgroups: vlan",
+            f"\tvlan: {_num + 1} vlanproto: 802.1q vlanpcp: 0 parent interface: igb0",
+            "\tmedia: Ethernet autoselect (1000baseT <full-duplex>)",
+            "\tstatus: active",
+            "\tnd6 options=21<PERFORMNUD,AUTO_LINKLOCAL>"
+        ]))
+        _netstat_link.append(f"{_if:<7} 1500 <Link#{_num + 3}>    {_mac}  {_num * 1000} 0 0 {_num * 150000} {_num * 900} 0 {_num * 120000} 0 0")
+        _netstat_inb.append(f"{_if:<7} 1500 <Link#{_num + 3}>    {_mac}  {_num * 1000} 0 0 {_num * 150000} {_num * 900} 0 {_num * 120000} 0")
+        _config_interfaces.append(f"<opt{_num + 1}><if>{_if}</if><descr>VLAN{_num + 1}</descr><enable>1</enable><ipaddr>{_ip}</ipaddr><subnet>24</subnet></opt{_num + 1}>")
+    _replay.save(["ifconfig","-m","-v","-f","inet:cidr,inet6:cidr"],"\n".join(_ifconfig) + "\n")
+    _replay.save(["/usr/bin/netstat","-i","-b","-d","-n","-W","-f","link"],"\n".join(_netstat_link) + "\n")
+    _replay.save(["netstat","-inb"],"\n".join(_netstat_inb) + "\n")
+
+    _ps = ["STAT USER       VSZ   RSS %CPU COMMAND"]
+    _pscomm = ["COMMAND            PID"]
+    for _num in range(processes):
+        _ps.append(f"S    www     {20000 + _num} {8000 + _num % 1000}  0.0 /usr/local/bin/php-cgi -c /usr/local/etc/php.ini worker{_num}")
+        _pscomm.append(f"php-cgi          {1000 + _num}")
+    _ps.append("RNL  root         0    16 400.0 [idle]")
+    _replay.save(["ps","ax","-o","state,user,vsz,rss,pcpu,command"],"\n".join(_ps) + "\n")
+    _replay.save(["ps","ax","-c","-o","command,pid"],"\n".join(_pscomm + ["dhcpd            99"]) + "\n")
+
+    _wgdump = ["wg0\tcHJpdmF0ZQ==\tcHVibGlj\t51820\toff"]
+    _wgclients = []
+    for _num in range(peers):
+        _pubkey = "peer{0:040d}=".format(_num)
+        _wgdump.append(f"wg0\t{_pubkey}\t(none)\t198.51.{_num >> 8 & 0xff}.{_num & 0xff}:51820\t10.200.{_num >> 8 & 0xff}.{_num & 0xff}/32\t{_now - _num % 600}\t{_num * 4096}\t{_num * 2048}\toff")
+        _wgclients.append(f"<client uuid=\"{_num:08x}-0000-0000-0000-000000000000\"><enabled>1</enabled><name>peer{_num}</name><pubkey>{_pubkey}</pubkey><tunneladdress>10.200.{_num >> 8 & 0xff}.{_num & 0xff}/32</tunneladdress></client>")
+    _replay.save(["wg","show","all","dump"],"\n".join(_wgdump) + "\n")
+
+    _replay.save(["sysctl","vm.stats"],"\n".join(map(lambda x: f"vm.stats.vm.{x[0]}: {x[1]}",(
+        ("v_page_size",4096),("v_page_count",2000000),("v_free_count",800000),("v_inactive_count",300000),("v_cache_count",0),("v_active_count",500000),("v_wire_count",400000)
+    ))) + "\n")
+    _replay.save(["sysctl","-q","kern.vm_guest","hw.model","hw.ncpu","hw.pagesize","hw.physmem"],"kern.vm_guest: kvm\nhw.model: QEMU Virtual CPU version 2.5+\nhw.ncpu: 8\nhw.pagesize: 4096\nhw.physmem: 8542347264\n")
+    _replay.save(["sysctl","-n","vm.loadavg"],"{ 0.31 0.25 0.22 }\n")
+    _replay.save(["top","-b","-n","1"],"last pid: 12345;  load averages:  0.31,  0.25,  0.22  up 10+01:02:03    12:00:00\n112 processes:  1 running, 111 sleeping\n")
+    _replay.save(["sysctl","-n","kern.lastpid"],"12345\n")
+    _replay.save(["df","-kTP","-t","ufs"],"Filesystem Type 1024-blocks Used Avail Capacity Mounted on\n/dev/gpt/rootfs ufs 20307196 4012344 14670280 21% /\n")
+    _replay.save(["mount","-p","-t","ufs"],"/dev/gpt/rootfs\t\t/\t\t\tufs\trw\t\t1 1\n")
+    _replay.save(["netstat","-na"],"\n".join(["Active Internet connections (including servers)"] + [f"tcp4       0      0 10.0.0.1.443           10.1.{_num >> 8 & 0xff}.{_num & 0xff}.50000        ESTABLISHED" for _num in range(interfaces)]) + "\n")
+    _replay.save(["hostname"],"fw.example.com\n")
+    _replay.save(["ntp_control","peers"],"* 192.0.2.1       .GPS.            1 u   33   64  377    0.462   -0.012    0.018\n+ 192.0.2.2       192.0.2.1        2 u   12   64  377    1.201    0.231    0.044")
+
+    _leases = []
+    _pools = []
+    for _num in range(leases):
+        _ip = "172.{0}.{1}.{2}".format(16 + (_num >> 16 & 0x0f),_num >> 8 & 0xff,_num & 0xff)
+        _leases.append("\n".join([
+            f"lease {_ip} {{",
+            "  starts 4 2024/01/01 00:00:00;",
+            "  ends 4 2024/01/01 02:00:00;",
+            "  cltt 4 2024/01/01 00:00:00;",
+            "  binding state active;",
+            "  next binding state free;",
+            "  rewind binding state free;",
+            "  hardware ethernet 02:01:{0:02x}:{1:02x}:{2:02x}:{3:02x};".format(_num >> 24 & 0xff,_num >> 16 & 0xff,_num >> 8 & 0xff,_num & 0xff),
+            f"  client-hostname \"host{_num}\";",
+            "}"
+        ]))
+    for _num in range(max(1,leases // 250)):
+        _pools.append(f"subnet 172.{16 + (_num >> 8 & 0x0f)}.{_num & 0xff}.0 netmask 255.255.255.0 {{\n  pool {{\n    range 172.{16 + (_num >> 8 & 0x0f)}.{_num & 0xff}.1 172.{16 + (_num >> 8 & 0x0f)}.{_num & 0xff}.254;\n  }}\n}}")
+    _file("/var/dhcpd/var/db/dhcpd.leases","\n".join(_leases) + "\n")
+    _file("/var/dhcpd/etc/dhcpd.conf","\n".join(_pools) + "\n")
+    _file("/var/dhcpd/var/run/dhcpd.pid","99\n")
+
+    _file("/conf/config.xml","<?xml version=\"1.0\"?>\n<opnsense>" +
+        "<interfaces>{0}</interfaces>".format("".join(_config_interfaces)) +
+        "<OPNsense><wireguard><client><clients>{0}</clients></client></wireguard></OPNsense>".format("".join(_wgclients)) +
+        "</opnsense>\n"
+    )
+    _file("/usr/local/opnsense/version/core",json.dumps({"product_name":"OPNsense","product_series":"24.1","product_version":"24.1.2_1"}))
+    _file("/usr/local/opnsense/changelog/index.json",json.dumps(
+        [{"series":"24.1","version":f"24.1.{_num}","date":"January 30, 2024"} for _num in range(1,10)]
+    ))
+
+class vici_stub(object):
+    ## strongswan vici socket answering list-conns/list-sas with generated tunnels
+    def __init__(self,agent,path,tunnels):
+        self._agent = agent
+        self._tunnels = tunnels
+        self._server = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        self._server.bind(path)
+        self._server.listen(4)
+        threading.Thread(target=self._serve,daemon=True).start()
+
+    @staticmethod
+    def _encode(name,data):
+        _ret = bytes([1,len(name)]) + name.encode("utf-8") ## SECTION_START
+        for _key,_value in data.items():
+            if type(_value) == dict:
+                _ret += vici_stub._encode(_key,_value)
+            else:
+                _value = str(_value).encode("utf-8")
+                _ret += bytes([3,len(_key)]) + _key.encode("utf-8") + struct.pack("!H",len(_value)) + _value ## KEY_VALUE
+        return _ret + bytes([2]) ## SECTION_END
+
+    @staticmethod
+    def _packet(packettype,name=None,message=b""):
+        _data = bytes([packettype])
+        if name:
+            _data += bytes([len(name)]) + name.encode("utf-8")
+        return struct.pack("!I",len(_data) + len(message)) + _data + message
+
+    def _events(self,command):
+        for _num in range(self._tunnels):
+            _conid = f"con{_num}"
+            if command == "list-conns":
+                yield self._packet(self._agent.vici_session.EVENT,"list-conn",self._encode(_conid,{"local-1": {"id": "fw.example.com"},"remote-1": {"id": f"peer{_num}.example.com"}}))
+            else:
+                yield self._packet(self._agent.vici_session.EVENT,"list-sa",self._encode(_conid,{
+                    "uniqueid": _num,"state": "ESTABLISHED","remote-host": f"198.51.100.{_num & 0xff}",
+                    "child-sas": {f"{_conid}-1": {"state": "INSTALLED","bytes-in": _num * 1000,"bytes-out": _num * 2000,"life-time": 3600}}
+                }))
+
+    def _serve(self):
+        while True:
+            _conn, _ = self._server.accept()
+            with _conn:
+                _reader = _conn.makefile("rb")
+                while True:
+                    _header = _reader.read(4)
+                    if len(_header) < 4:
+                        break
+                    _data = _reader.read(struct.unpack("!I",_header)[0])
+                    _name = _data[2:2 + _data[1]].decode("utf-8") if len(_data) > 1 else ""
+                    if _data[0] in (self._agent.vici_session.EVENT_REGISTER,self._agent.vici_session.EVENT_UNREGISTER):
+                        _conn.sendall(self._packet(self._agent.vici_session.EVENT_CONFIRM))
+                    elif _data[0] == self._agent.vici_session.CMD_REQUEST:
+                        _conn.sendall(b"".join(self._events(_name)) + self._packet(self._agent.vici_session.CMD_RESPONSE,message=b""))
+
+class ntp_stub(object):
+    ## ntpd mode 6 responder, READSTAT and READVAR for generated peers, replies split in fragments
+    def __init__(self,peers):
+        self._peers = peers
+        self._sock = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+        self._sock.bind(("127.0.0.1",0))
+        self.address = self._sock.getsockname()
+        threading.Thread(target=self._serve,daemon=True).start()
+
+    def _serve(self):
+        _rec = int(time.time()) + 2208988800 - 33
+        while True:
+            _data, _remote = self._sock.recvfrom(1024)
+            _, _opcode, _sequence, _, _associd, _, _ = struct.unpack_from("!BBHHHHH",_data)
+            if _opcode == 1:
+                _payload = b"".join(map(lambda x: struct.pack("!HH",x + 1,0x9414 if x else 0x961a),range(self._peers)))
+            else:
+                _payload = "srcadr=192.0.2.{0}, refid=GPS, stratum=1, hmode=3, hpoll=6, ppoll=6, reach=0xff, rec=0x{1:08x}.00000000, delay=0.462, offset=-0.012, jitter=0.018".format(_associd & 0xff,_rec).encode("ascii")
+            for _offset in range(0,max(1,len(_payload)),468):
+                _fragment = _payload[_offset:_offset + 468]
+                _more = 0x20 if _offset + 468 < len(_payload) else 0
+                self._sock.sendto(struct.pack("!BBHHHHH",0x16,0x80 | _more | _opcode,_sequence,0,_associd,_offset,len(_fragment)) + _fragment,_remote)
+
+def ntp_poll(agent,checker):
+    ## live path of check_ntp, check_ntp itself answers from the fixtures in replay mode
+    with agent.ntp_control() as _ntp:
+        return list(map(lambda x: checker._ntp_peerline(x[1],_ntp.peervars(x[0]),time.time()),_ntp.peers()))
+
+def get_check(agent,checker,name):
+    if name == "ipsec_vici":
+        return checker._get_ipsec_status if hasattr(agent,"vici_session") else None
+    if name == "config_reader":
+        return lambda: list(checker._config_reader())
+    if name == "ntp_control":
+        return (lambda: ntp_poll(agent,checker)) if hasattr(agent,"ntp_control") else None
+    for _prefix in ("check_","checklocal_"):
+        if hasattr(checker,f"{_prefix}{name}"):
+            return getattr(checker,f"{_prefix}{name}")
+    return None
+
+def measure(func,rounds):
+    _wall = []
+    _result = None
+    for _ in range(rounds):
+        _start = time.perf_counter()
+        _result = func()
+        _wall.append(time.perf_counter() - _start)
+    tracemalloc.start()
+    func()
+    _current, _peak = tracemalloc.get_traced_memory()
+    _snapshot = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    _blocks = sum(map(lambda x: x.count,_snapshot.statistics("filename")))
+    _wall.sort()
+    return _wall[len(_wall) // 2],_wall[-1],_peak,_blocks,_result
+
+IMPORT_PROBE = """
+import sys, time, resource, importlib.util
+_start = time.perf_counter()
+if sys.argv[1]:
+    _spec = importlib.util.spec_from_file_location("opnsense_checkmk_agent",sys.argv[1])
+    _spec.loader.exec_module(importlib.util.module_from_spec(_spec))
+print(time.perf_counter() - _start,resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,"asyncio" in sys.modules)
+"""
+
+def import_benchmark(path,rounds):
+    ## fresh interpreter per round, bare python as baseline for the rss
+    sys.stdout.write("import;median_ms;max_ms;maxrss_kib;rss_over_python_kib;asyncio_loaded\n")
+    _results = {}
+    for _name,_path in (("python",""),("agent",path)):
+        _runs = []
+        for _ in range(rounds):
+            _out = subprocess.check_output([sys.executable,"-c",IMPORT_PROBE,_path],text=True).split()
+            _runs.append((float(_out[0]),int(_out[1]),_out[2]))
+        _runs.sort()
+        _rss = sorted(map(lambda x: x[1],_runs))[len(_runs) // 2] ## kib on linux/freebsd
+        _results[_name] = (_runs[len(_runs) // 2][0],_rss)
+        sys.stdout.write(f"{_name};{_results[_name][0] * 1000:.2f};{_runs[-1][0] * 1000:.2f};{_rss};{_rss - _results['python'][1]};{_runs[-1][2]}\n")
+    sys.stdout.flush()
+
+def run_benchmark(agent,directory,sections,rounds,peers=5000):
+    _checker = agent.checkmk_server(0,os.path.join(directory,"bench.pid"),pwd.getpwuid(os.getuid()).pw_name,replay=directory)
+    ## socket based sources are not recorded, they are served by stubs
+    if "ipsec_vici" in sections and hasattr(agent,"vici_session"):
+        agent.VICI_SOCKET = os.path.join(directory,"charon.vici")
+        vici_stub(agent,agent.VICI_SOCKET,peers)
+    if "ntp_control" in sections and hasattr(agent,"ntp_control"):
+        agent.NTP_CONTROL = ntp_stub(min(peers,500)).address
+    sys.stdout.write("section;median_ms;max_ms;peak_kib;live_blocks;lines\n")
+    for _name in sections:
+        _check = get_check(agent,_checker,_name)
+        if not _check:
+            sys.stdout.write(f"{_name};not available\n")
+            continue
+        try:
+            _median, _max, _peak, _blocks, _result = measure(_check,rounds)
+        except Exception as e:
+            sys.stdout.write(f"{_name};failed {e!r}\n")
+            continue
+        sys.stdout.write(f"{_name};{_median * 1000:.2f};{_max * 1000:.2f};{_peak / 1024:.0f};{_blocks};{len(_result or [])}\n")
+    _median, _max, _peak, _blocks, _result = measure(_checker.do_checks,rounds)
+    sys.stdout.write(f"full_poll;{_median * 1000:.2f};{_max * 1000:.2f};{_peak / 1024:.0f};{_blocks};{len(_result.splitlines())}\n")
+    sys.stdout.flush()
+
+if __name__ == "__main__":
+    import argparse
+    _parser = argparse.ArgumentParser("benchmark for the opnsense checkmk_agent")
+    _parser.add_argument("--agent",type=str,default=AGENT,
+        help="agent file to benchmark")
+    _parser.add_argument("--fixtures",type=str,
+        help="fixture directory, generated if it does not exist, a --record directory is replayed as is")
+    _parser.add_argument("--interfaces",type=int,default=1000)
+    _parser.add_argument("--leases",type=int,default=10000)
+    _parser.add_argument("--peers",type=int,default=5000)
+    _parser.add_argument("--processes",type=int,default=20000)
+    _parser.add_argument("--rounds",type=int,default=5)
+    _parser.add_argument("--import-time",action="store_true",
+        help="only measure import time and maxrss of the agent module")
+    _parser.add_argument("--sections",type=str,default=",".join(SECTIONS),
+        help="comma seperated checks")
+    args = _parser.parse_args()
+
+    if args.import_time:
+        import_benchmark(os.path.abspath(args.agent),max(args.rounds,5))
+        sys.exit(0)
+    _agent = load_agent(args.agent)
+    _directory = args.fixtures or tempfile.mkdtemp(prefix="checkmk_bench_")
+    try:
+        if not os.path.isdir(os.path.join(_directory,"commands")):
+            generate_fixtures(_agent,_directory,interfaces=args.interfaces,leases=args.leases,peers=args.peers,processes=args.processes)
+        sys.stdout.write(f"agent: {args.agent}\nfixtures: {_directory} interfaces={args.interfaces} leases={args.leases} peers={args.peers} processes={args.processes} rounds={args.rounds}\n")
+        run_benchmark(_agent,_directory,args.sections.split(","),args.rounds,peers=args.peers)
+    finally:
+        if not args.fixtures:
+            shutil.rmtree(_directory,ignore_errors=True)
@@ -27,32 +27,28 @@ __VERSION__ = "0.99.2"
 import sys
 import os
 import shlex
-import glob
 import re
 import time
 import json
 import socket
+import select
+import selectors
 import signal
 import struct
 import subprocess
 import pwd
+import shutil
 import threading
 import ipaddress
 import base64
+import hashlib
+import zlib
 import traceback
 import syslog
-import requests
-from urllib3.connection import HTTPConnection
-from urllib3.connectionpool import HTTPConnectionPool
-from requests.adapters import HTTPAdapter
-from cryptography import x509
-from cryptography.hazmat.backends import default_backend as crypto_default_backend
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+import resource
+import collections
 from xml.etree import cElementTree as ELementTree
 from collections import Counter,defaultdict
-from pprint import pprint
 from socketserver import TCPServer,StreamRequestHandler
 
 SCRIPTPATH = os.path.abspath(os.path.basename(__file__))
@@ -63,11 +59,140 @@ MK_CONFDIR = os.path.join(BASEDIR,"etc")
 CHECKMK_CONFIG = os.path.join(MK_CONFDIR,"checkmk.conf")
 LOCALDIR = os.path.join(BASEDIR,"local")
 SPOOLDIR = os.path.join(BASEDIR,"spool")
+LOCAL_TIMEBUDGET = 25
+ZFS_CACHETIME = 300
+DELTA_INTERVAL = 300
+PERF_SAMPLES = 100
+CACHE_MAXSIZE = 4096
+CACHE_TTL = 86400
+RATELIMIT_BURST = 3
+THROTTLE_MAXAGE = 300
+## kstat.zfs.misc.arcstats counters used by the zfs_arc_cache check
+ZFS_ARCSTATS = ("hits","misses","demand_data_hits","demand_data_misses","demand_metadata_hits","demand_metadata_misses",
+    "prefetch_data_hits","prefetch_data_misses","prefetch_metadata_hits","prefetch_metadata_misses",
+    "size","c","c_min","c_max","p","arc_meta_used","arc_meta_limit","arc_meta_max","l2_hits","l2_misses","l2_size","l2_asize")
+## netinet/tcp_fsm.h order, names as in checkmk tcp_conn_stats
+TCP_STATES = ("CLOSED","LISTEN","SYN_SENT","SYN_RECV","ESTABLISHED","CLOSE_WAIT","FIN_WAIT1","CLOSING","LAST_ACK","FIN_WAIT2","TIME_WAIT")
+
+REGEX_SECTION_HEADER = re.compile(r"\B[<]{3}(.*?)[>]{3}\B")
+REGEX_SPOOL_MAXAGE = re.compile(r"^\d+")
+REGEX_REPLAY_FILENAME = re.compile(r"[^\w.-]+")
+REGEX_PIDOF = re.compile(r"(\w+)\s+(\d+)")
+REGEX_IPDATA = re.compile(r"(?P<inet>inet6?)\s(?P<ip>[\da-f:.]+)\/(?P<cidr>\d+).*?(?:vhid\s(?P<vhid>\d+)|$)|carp:\s(?P<carp_status>MASTER|BACKUP)\svhid\s(?P<carp_vhid>\d+)\sadvbase\s(?P<carp_base>\d+)\sadvskew\s(?P<carp_skew>\d)|(vlan):\s(?P<vlan>\d*)",re.DOTALL | re.M)
+REGEX_IFCONFIG_SHORT = re.compile(r"([\w_]+):\s(.*?)\n(?=(?:\w|$))",re.DOTALL | re.M)
+REGEX_IFCONFIG = re.compile(r"^(?P<iface>[\w.]+):\s(?P<data>.*?(?=^\w))",re.DOTALL | re.M)
+REGEX_IFCONFIG_KEYVALUE = re.compile(r"^\s*(\w+)[:\s=]+(.*?)$",re.M)
+REGEX_IF_DESCRIPTION = re.compile(r"_\((lan|wan|opt\d)\)")
+REGEX_IF_FLAGS = re.compile(r"^[a-f\d]+")
+REGEX_IF_MEDIA = re.compile(r"\((?P<speed>\d+G?)base(?:.*?<(?P<duplex>.*?)>)?")
+REGEX_IF_INET = re.compile(r"^(?P<ipaddr>[\d.]+)\/(?P<cidr>\d+).*?(?:vhid\s(?P<vhid>\d+)|$)",re.M)
+REGEX_IF_INET6 = re.compile(r"^(?P<ipaddr>[0-9a-f:]+)\/(?P<prefix>\d+).*?(?:vhid\s(?P<vhid>\d+)|$)",re.M)
+REGEX_IF_CARP = re.compile(r"(?P<status>MASTER|BACKUP)\svhid\s(?P<vhid>\d+)\sadvbase\s(?P<base>\d+)\sadvskew\s(?P<skew>\d+)",re.M)
+REGEX_IF_BRIDGE_PRIORITY = re.compile(r"priority\s(\d+)")
+REGEX_DHCP_LEASE = re.compile(r"lease\s(?P<ipaddr>[0-9.]+)\s\{.*?.\n\s+binding state\s(?P<state>active).*?\}",re.DOTALL)
+REGEX_DHCP_SUBNET = re.compile(r"subnet\s(?P<subnet>[0-9.]+)\snetmask\s(?P<netmask>[0-9.]+)\s\{.*?(?:pool\s\{.*?\}.*?)*}",re.DOTALL)
+REGEX_DHCP_POOL = re.compile(r"pool\s\{.*?range\s(?P<start>[0-9.]+)\s(?P<end>[0-9.]+).*?\}",re.DOTALL)
+REGEX_DPINGER = re.compile(r"(\w+)\s(\d+)\s(\d+)\s(\d+)$")
+REGEX_OPENVPN_BYTES = re.compile(r"bytes\w+=(\d+)")
+REGEX_UNBOUND_CONTROL = re.compile(r"^\s*(control-[\w-]+):\s*\"?([^\s\"]+)",re.M)
+REGEX_DISCPATH = re.compile(r"(sd[a-z]+|da[0-9]+|nvme[0-9]+|ada[0-9]+)$")
+REGEX_IPMI_AVAILABLE = re.compile(r"^(?!.*\sna\s.*$).*",re.M)
+REGEX_TCP_STATE = re.compile(r"ESTABLISHED|LISTEN")
+REGEX_PS_IDLE = re.compile(r"(\d+):[\d.]+\s+\[idle\]")
+REGEX_PFCTL_COUNTER = re.compile(r"^\s+(?P<name>\S.*?)\s{2,}(?P<value>\d+)")
+REGEX_PFCTL_LIMIT = re.compile(r"^(?P<name>\S+)\s+hard limit\s+(?P<value>\d+)",re.M)
+REGEX_CONFIGFILE = re.compile(r"^(\w+):\s*(.*?)(?:\s+#|$)",re.M)
+REGEX_SOCKSTAT_PID = re.compile(r"\s(\d+)\s")
+VICI_SOCKET = "/var/run/charon.vici"
+NTP_CONTROL = ("127.0.0.1",123)
 
 class object_dict(defaultdict):
     def __getattr__(self,name):
         return self[name] if name in self else ""
 
+class bounded_store(object):
+    ## lru dict with max size and idle timeout for the long running daemon
+    def __init__(self,maxsize=1024,ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = collections.OrderedDict()
+        self._mutex = threading.RLock()
+
+    def _expire(self,now):
+        if self.ttl:
+            while self._data:
+                _key, (_atime,_) = next(iter(self._data.items()))
+                if now - _atime <= self.ttl:
+                    break
+                del self._data[_key]
+
+    def get(self,key,default=None):
+        with self._mutex:
+            _now = time.time()
+            self._expire(_now)
+            if key not in self._data:
+                return default
+            _value = self._data.pop(key)[1]
+            self._data[key] = (_now,_value)
+            return _value
+
+    def __setitem__(self,key,value):
+        with self._mutex:
+            _now = time.time()
+            self._data.pop(key,None)
+            self._data[key] = (_now,value)
+            self._expire(_now)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def __getitem__(self,key):
+        _value = self.get(key,self)
+        if _value is self:
+            raise KeyError(key)
+        return _value
+
+    def __contains__(self,key):
+        return self.get(key,self) is not self
+
+    def __len__(self):
+        with self._mutex:
+            self._expire(time.time())
+            return len(self._data)
+
+    def items(self):
+        with self._mutex:
+            self._expire(time.time())
+            return [(_key,_value) for _key,(_,_value) in self._data.items()]
+
+    def values(self):
+        return [_value for _,_value in self.items()]
+
+class ip_allowlist(object):
+    ## networks indexed by ip version and prefix length, a lookup masks the address once per prefix length
+    def __init__(self,networks):
+        self._index = {}
+        for _network in networks:
+            try:
+                _network = ipaddress.ip_network(_network.strip(),strict=False)
+            except ValueError:
+                log(f"onlyfrom: ignoring invalid network {_network}","warning")
+                continue
+            self._index.setdefault(_network.version,{}).setdefault(_network.prefixlen,set()).add(int(_network.network_address))
+
+    def __contains__(self,address):
+        try:
+            _address = ipaddress.ip_address(address)
+        except ValueError:
+            return False
+        if _address.version == 6 and _address.ipv4_mapped:
+            _address = _address.ipv4_mapped
+        _hostbits = _address.max_prefixlen
+        _int = int(_address)
+        for _prefixlen, _networks in self._index.get(_address.version,{}).items():
+            if (_int >> (_hostbits - _prefixlen)) << (_hostbits - _prefixlen) in _networks:
+                return True
+        return False
+
 def etree_to_dict(t):
     d = {t.tag: {} if t.attrib else None}
     children = list(t)
@@ -107,23 +232,358 @@ def pad_pkcs7(message,size=16):
     else:
         return message + bytes([_pad]) * _pad
 
-class NginxConnection(HTTPConnection):
-    def __init__(self):
-        super().__init__("localhost")
-    def connect(self):
-        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        self.sock.connect("/var/run/nginx_status.sock")
+def nginx_adapter():
+    ## requests/urllib3 are only loaded when nginx is configured
+    from urllib3.connection import HTTPConnection
+    from urllib3.connectionpool import HTTPConnectionPool
+    from requests.adapters import HTTPAdapter
+
+    class NginxConnection(HTTPConnection):
+        def __init__(self):
+            super().__init__("localhost")
+        def connect(self):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect("/var/run/nginx_status.sock")
+
+    class NginxConnectionPool(HTTPConnectionPool):
+        def __init__(self):
+            super().__init__("localhost")
+        def _new_conn(self):
+            return NginxConnection()
+
+    class NginxAdapter(HTTPAdapter):
+        def get_connection(self, url, proxies=None):
+            return NginxConnectionPool()
+
+    return NginxAdapter()
+
+class vici_session(object):
+    ## strongswan vici protocol https://github.com/strongswan/strongswan/blob/master/src/libcharon/plugins/vici/README.md
+    CMD_REQUEST, CMD_RESPONSE, CMD_UNKNOWN, EVENT_REGISTER, EVENT_UNREGISTER, EVENT_CONFIRM, EVENT_UNKNOWN, EVENT = range(8)
+    SECTION_START, SECTION_END, KEY_VALUE, LIST_START, LIST_ITEM, LIST_END = range(1,7)
+    def __init__(self,path=None,timeout=10):
+        self._sock = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        self._sock.settimeout(timeout)
+        try:
+            self._sock.connect(path or VICI_SOCKET)
+        except:
+            self._sock.close()
+            raise
 
-class NginxConnectionPool(HTTPConnectionPool):
-    def __init__(self):
-        super().__init__("localhost")
-    def _new_conn(self):
-        return NginxConnection()
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self._sock.close()
+
+    def _send(self,packettype,name=None,message=b""):
+        _data = bytes([packettype])
+        if name is not None:
+            _name = name.encode("utf-8")
+            _data += bytes([len(_name)]) + _name
+        _data += message
+        self._sock.sendall(struct.pack("!I",len(_data)) + _data)
+
+    def _recvall(self,size):
+        _data = bytearray()
+        while len(_data) < size:
+            _chunk = self._sock.recv(size - len(_data))
+            if not _chunk:
+                raise ConnectionError("vici socket closed")
+            _data += _chunk
+        return bytes(_data)
+
+    def _recv(self):
+        _length = struct.unpack("!I",self._recvall(4))[0]
+        _data = self._recvall(_length)
+        _name = None
+        _pos = 1
+        if _data[0] in (self.CMD_REQUEST,self.EVENT_REGISTER,self.EVENT_UNREGISTER,self.EVENT):
+            _pos = 2 + _data[1]
+            _name = _data[2:_pos].decode("utf-8")
+        return _data[0],_name,_data[_pos:]
+
+    @classmethod
+    def decode(cls,message):
+        _ret = {}
+        _sections = [_ret]
+        _list = None
+        _pos = 0
+        while _pos < len(message):
+            _element = message[_pos]
+            _pos += 1
+            if _element == cls.SECTION_END:
+                _sections.pop()
+                continue
+            if _element == cls.LIST_END:
+                _list = None
+                continue
+            if _element == cls.LIST_ITEM:
+                _length = struct.unpack_from("!H",message,_pos)[0]
+                _list.append(message[_pos+2:_pos+2+_length].decode("utf-8","replace"))
+                _pos += 2 + _length
+                continue
+            _name = message[_pos+1:_pos+1+message[_pos]].decode("utf-8","replace")
+            _pos += 1 + message[_pos]
+            if _element == cls.SECTION_START:
+                _sections[-1][_name] = {}
+                _sections.append(_sections[-1][_name])
+            elif _element == cls.KEY_VALUE:
+                _length = struct.unpack_from("!H",message,_pos)[0]
+                _sections[-1][_name] = message[_pos+2:_pos+2+_length].decode("utf-8","replace")
+                _pos += 2 + _length
+            elif _element == cls.LIST_START:
+                _list = _sections[-1][_name] = []
+            else:
+                raise ValueError(f"vici invalid element {_element}")
+        return _ret
 
-class NginxAdapter(HTTPAdapter):
-    def get_connection(self, url, proxies=None):
-        return NginxConnectionPool()
+    def streamed_request(self,command,event):
+        self._send(self.EVENT_REGISTER,event)
+        if self._recv()[0] != self.EVENT_CONFIRM:
+            raise ConnectionError(f"vici event {event} not registered")
+        try:
+            self._send(self.CMD_REQUEST,command)
+            while True:
+                _type, _name, _message = self._recv()
+                if _type == self.EVENT and _name == event:
+                    yield self.decode(_message)
+                elif _type == self.CMD_RESPONSE:
+                    break
+                else:
+                    raise ConnectionError(f"vici command {command} failed")
+        finally:
+            self._send(self.EVENT_UNREGISTER,event)
+            self._recv()
+
+
+class ntp_control(object):
+    ## ntpd mode 6 control messages, the protocol ntpq uses (rfc 9327)
+    READSTAT, READVAR = 1, 2
+    PEERVARS = "srcadr,refid,stratum,hmode,hpoll,ppoll,reach,rec,reftime,delay,offset,jitter"
+    TALLY = " x.-+#*o" ## peer selection code
+    def __init__(self,address=None,timeout=2):
+        address = address or NTP_CONTROL
+        self._sock = socket.socket(socket.AF_INET6 if ":" in address[0] else socket.AF_INET,socket.SOCK_DGRAM)
+        self._deadline = time.monotonic() + timeout
+        self._sequence = 0
+        try:
+            self._sock.connect(address)
+        except:
+            self._sock.close()
+            raise
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self._sock.close()
+
+    def request(self,opcode,associd=0,data=b""):
+        self._sequence = (self._sequence + 1) & 0xffff
+        _packet = struct.pack("!BBHHHHH",0x16,opcode,self._sequence,0,associd,0,len(data)) + data ## version 2, mode 6
+        self._sock.send(_packet + b"\0" * (-len(_packet) % 4))
+        _fragments = {}
+        _end = None
+        while _end == None or sum(map(len,_fragments.values())) < _end:
+            self._sock.settimeout(max(0,self._deadline - time.monotonic()))
+            _response = self._sock.recv(4096)
+            if len(_response) < 12:
+                continue
+            _, _flags, _sequence, _, _associd, _offset, _count = struct.unpack_from("!BBHHHHH",_response)
+            if _sequence != self._sequence or _flags & 0x1f != opcode or not _flags & 0x80:
+                continue ## late answer to an earlier request
+            if _flags & 0x40:
+                raise ConnectionError(f"ntp control opcode {opcode} error")
+            _fragments[_offset] = _response[12:12 + _count]
+            if not _flags & 0x20: ## no more fragments
+                _end = _offset + _count
+        return b"".join(map(lambda x: _fragments[x],sorted(_fragments)))
+
+    def peers(self):
+        _data = self.request(self.READSTAT)
+        return [struct.unpack_from("!HH",_data,_pos) for _pos in range(0,len(_data) - 3,4)]
+
+    def peervars(self,associd):
+        _ret = {}
+        for _var in self.request(self.READVAR,associd,self.PEERVARS.encode("ascii")).decode("ascii","replace").split(","):
+            _key, _, _value = _var.strip().partition("=")
+            _ret[_key] = _value.strip().strip('"')
+        return _ret
+
+
+class checkmk_process_runner(object):
+    def __init__(self,limits=None):
+        self._limits = limits if limits else {"default": 8, "cached": 8}
+        self._mutex = threading.Lock()
+        self._loop = None
+        self._pid = None
+        self._semaphores = {}
+
+    def _get_loop(self):
+        import asyncio ## only loaded once the first process runs, keeps it out of the agent startup
+        with self._mutex:
+            if self._loop == None or self._pid != os.getpid(): ## new loop after daemonize fork
+                self._pid = os.getpid()
+                self._semaphores = {}
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever,name="process_runner",daemon=True).start()
+            return self._loop
+
+    async def execute(self,process,shell=False,timeout=60,pool="default"):
+        import asyncio
+        if pool not in self._semaphores:
+            self._semaphores[pool] = asyncio.Semaphore(self._limits.get(pool,self._limits.get("default")))
+        async with self._semaphores[pool]:
+            _argv = list(process)
+            if shell: ## like subprocess with a list and shell=True, process[0] is the script, the rest are its positional args
+                _argv = ["/bin/sh","-c"] + _argv
+            _proc = await asyncio.create_subprocess_exec(*_argv,stdin=subprocess.DEVNULL,stdout=subprocess.PIPE,stderr=subprocess.DEVNULL,start_new_session=True)
+            try:
+                _out, _ = await asyncio.wait_for(_proc.communicate(),timeout)
+            except asyncio.TimeoutError:
+                try:
+                    os.killpg(_proc.pid,signal.SIGKILL) ## whole process group, no orphans
+                except ProcessLookupError:
+                    pass
+                await _proc.wait()
+                raise subprocess.TimeoutExpired(process,timeout)
+            _out = _out.decode("utf-8","replace")
+            if _proc.returncode != 0:
+                raise subprocess.CalledProcessError(_proc.returncode,process,output=_out)
+            return _out
+
+    def run(self,process,shell=False,timeout=60,pool="default"):
+        import asyncio
+        return asyncio.run_coroutine_threadsafe(self.execute(process,shell=shell,timeout=timeout,pool=pool),self._get_loop()).result()
+
+    def run_many(self,processes,shell=False,timeout=60,pool="default"):
+        import asyncio
+        async def _gather():
+            return await asyncio.gather(*[self.execute(_process,shell=shell,timeout=timeout,pool=pool) for _process in processes],return_exceptions=True)
+        return asyncio.run_coroutine_threadsafe(_gather(),self._get_loop()).result()
+
+class checkmk_replay(object):
+    ## recorded command output and files to run the checks off the firewall (benchmark/debug)
+    def __init__(self,directory,record=False):
+        self.directory = directory
+        self.record = record
+
+    def _command_file(self,process):
+        return os.path.join(self.directory,"commands",REGEX_REPLAY_FILENAME.sub("_"," ".join(process)).strip("_"))
+
+    def path(self,path):
+        _replay_path = os.path.join(self.directory,"files",path.lstrip(os.path.sep))
+        if not self.record:
+            return _replay_path
+        if os.path.isfile(path):
+            os.makedirs(os.path.dirname(_replay_path),exist_ok=True)
+            shutil.copy(path,_replay_path)
+        return path
+
+    def run(self,process):
+        try:
+            with open(self._command_file(process),"r") as _f:
+                return _f.read()
+        except FileNotFoundError:
+            return ""
+
+    def save(self,process,output):
+        _filename = self._command_file(process)
+        os.makedirs(os.path.dirname(_filename),exist_ok=True)
+        with open(_filename,"w") as _f:
+            _f.write(output if output else "")
+
+class checkmk_watcher(object):
+    ## change counter per file or directory, kqueue vnode events on FreeBSD, a stat per lookup elsewhere
+    def __init__(self):
+        self._mutex = threading.Lock()
+        self._generation = {}
+        self._stat = {}
+        self._kqueue = None
+        self._pid = None
+        self._watched = {}
+        self._pending = set()
+
+    def generation(self,path):
+        if not hasattr(select,"kqueue"):
+            return self._stat_generation(path)
+        with self._mutex:
+            if self._kqueue == None or self._pid != os.getpid(): ## kqueue is not inherited by fork
+                self._pid = os.getpid()
+                self._kqueue = select.kqueue()
+                self._watched = {}
+                self._pending = set()
+                threading.Thread(target=self._kqueue_loop,args=(self._kqueue,),name="watcher",daemon=True).start()
+            if path not in self._generation:
+                self._generation[path] = 0
+                self._kqueue_watch(path)
+            return self._generation[path]
+
+    def _stat_generation(self,path):
+        try:
+            _stat = os.stat(path)
+            _stat = (_stat.st_ino,_stat.st_mtime_ns,_stat.st_size)
+        except OSError:
+            _stat = None
+        with self._mutex:
+            if path not in self._generation:
+                self._generation[path] = 0
+            elif self._stat.get(path) != _stat:
+                self._generation[path] += 1
+            self._stat[path] = _stat
+            return self._generation[path]
+
+    def _kqueue_watch(self,path):
+        try:
+            _fd = os.open(path,os.O_RDONLY)
+        except OSError:
+            self._pending.add(path) ## retried until it exists
+            return False
+        self._watched[_fd] = path
+        self._kqueue.control([select.kevent(_fd,
+            filter=select.KQ_FILTER_VNODE,
+            flags=select.KQ_EV_ADD | select.KQ_EV_CLEAR,
+            fflags=select.KQ_NOTE_WRITE | select.KQ_NOTE_EXTEND | select.KQ_NOTE_ATTRIB | select.KQ_NOTE_DELETE | select.KQ_NOTE_RENAME
+        )],0)
+        return True
+
+    def _kqueue_loop(self,kqueue):
+        while kqueue == self._kqueue:
+            _events = kqueue.control(None,16,1) ## wake up to retry pending paths
+            with self._mutex:
+                for _path in list(self._pending):
+                    if os.path.exists(_path):
+                        self._pending.discard(_path)
+                        if self._kqueue_watch(_path):
+                            self._generation[_path] += 1
+                for _event in _events:
+                    _path = self._watched.get(_event.ident)
+                    if _path == None:
+                        continue
+                    if _event.fflags & (select.KQ_NOTE_DELETE | select.KQ_NOTE_RENAME): ## replaced, watch the new file
+                        self._watched.pop(_event.ident)
+                        os.close(_event.ident)
+                        self._kqueue_watch(_path)
+                    self._generation[_path] += 1
+
+def sysctlbyname(name):
+    import ctypes
+    import ctypes.util
+    if not hasattr(sysctlbyname,"libc"):
+        sysctlbyname.libc = ctypes.CDLL(ctypes.util.find_library("c"),use_errno=True)
+    try:
+        _sysctlbyname = sysctlbyname.libc.sysctlbyname
+    except AttributeError: ## no bsd libc
+        raise OSError(f"sysctl {name} not supported")
+    _name = name.encode("utf-8")
+    _size = ctypes.c_size_t(0)
+    if _sysctlbyname(_name,None,ctypes.byref(_size),None,ctypes.c_size_t(0)) != 0:
+        raise OSError(ctypes.get_errno(),f"sysctl {name}")
+    _buffer = ctypes.create_string_buffer(_size.value)
+    if _sysctlbyname(_name,_buffer,ctypes.byref(_size),None,ctypes.c_size_t(0)) != 0:
+        raise OSError(ctypes.get_errno(),f"sysctl {name}")
+    return _buffer.raw[:_size.value]
 
 def check_pid(pid):
     try:
@@ -134,9 +594,17 @@ def check_pid(pid):
 
 class checkmk_handler(StreamRequestHandler):
     def handle(self):
+        if not self.server.admit_request(self.client_address[0]):
+            ## throttled, never start a new collection
+            try:
+                self.wfile.write(self.server.throttled_payload())
+            except:
+                pass
+            return
         with self.server._mutex:
             try:
                 _strmsg = self.server.do_checks(remote_ip=self.client_address[0])
+                self.server._last_payload = (time.monotonic(),_strmsg)
             except Exception as e:
                 raise
                 _strmsg = str(e).encode("utf-8")
@@ -144,16 +612,39 @@ class checkmk_handler(StreamRequestHandler):
                 self.wfile.write(_strmsg)
             except:
                 pass
+        self.server.realtime_trigger(self.client_address[0])
 
 class checkmk_checker(object):
-    _available_sysctl_list = []
-    _available_sysctl_temperature_list = []
-    _certificate_timestamp = 0
-    _check_cache = {}
+    _all_interfaces = object_dict()
+    _net_interfaces = []
+    _carp_interfaces = object_dict()
+    _available_sysctl_temperature_list = None
+    _certificate_generation = None
+    _unbound_stats = (0,{})
+    _check_cache = bounded_store(maxsize=CACHE_MAXSIZE,ttl=CACHE_TTL)
+    _process_runner = checkmk_process_runner()
+    _provider = None
+    _localdir_cache = ((),[])
+    _watcher = checkmk_watcher()
+    _config_cache = (None,{})
+    _opnsense_interfaces = (None,{})
+    _host_facts = None
+    _osinfo_cache = (None,{})
+    _spool_index = {}
+    _section_cache = {}
+    _perf_data = bounded_store(maxsize=CACHE_MAXSIZE,ttl=CACHE_TTL)
+    _perf_local = threading.local()
     _datastore_mutex = threading.RLock()
     _datastore = object_dict()
 
     def encrypt(self,message,password='secretpassword'):
+        return b"".join(self._encrypt_stream([message.encode("utf-8")],password=password))
+
+    def _encrypt_stream(self,stream,password='secretpassword'):
+        from cryptography.hazmat.backends import default_backend as crypto_default_backend
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+        from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
         SALT_LENGTH = 8
         KEY_LENGTH = 32
         IV_LENGTH = 16
@@ -161,7 +652,7 @@ class checkmk_checker(object):
         SALT = b"Salted__"
         _backend = crypto_default_backend()
         _kdf_key =  PBKDF2HMAC(
-            algorithm = hashes.SHA256,
+            algorithm = hashes.SHA256(),
             length = KEY_LENGTH + IV_LENGTH,
             salt = SALT,
             iterations = PBKDF2_CYCLES,
@@ -173,10 +664,51 @@ class checkmk_checker(object):
             modes.CBC(_iv),
             backend = _backend
         ).encryptor()
-        message = pad_pkcs7(message)
-        message = message.encode("utf-8")
-        _encrypted_message = _encryptor.update(message) + _encryptor.finalize()
-        return pad_pkcs7(b"03",10) + SALT + _encrypted_message
+        yield pad_pkcs7(b"03",10) + SALT
+        _length = 0
+        for _chunk in stream:
+            _length += len(_chunk)
+            yield _encryptor.update(_chunk)
+        _pad = 16 - (_length % 16)
+        yield _encryptor.update(bytes([_pad]) * _pad) + _encryptor.finalize()
+
+    @staticmethod
+    def _compress_stream(stream,level=6):
+        _compressor = zlib.compressobj(level)
+        for _chunk in stream:
+            _data = _compressor.compress(_chunk)
+            if _data:
+                yield _data
+        yield _compressor.flush()
+
+    @staticmethod
+    def _chunk_stream(lines,size=65536):
+        _chunk = []
+        _length = 0
+        for _num,_line in enumerate(lines):
+            if type(_line) == bytes: ## prerendered section
+                _chunk.append("\n" if _num else "")
+                yield "".join(_chunk).encode("utf-8") + _line
+                _chunk = []
+                _length = 0
+                continue
+            _line = ("\n" if _num else "") + _line
+            _chunk.append(_line)
+            _length += len(_line)
+            if _length >= size:
+                yield "".join(_chunk).encode("utf-8")
+                _chunk = []
+                _length = 0
+        if _chunk:
+            yield "".join(_chunk).encode("utf-8")
+
+    def _output_stream(self,lines):
+        _stream = self._chunk_stream(lines)
+        if self.compress == "zlib": ## compress before encryption
+            _stream = self._compress_stream(_stream)
+        if self.encryptionkey:
+            _stream = self._encrypt_stream(_stream,password=self.encryptionkey)
+        return _stream
 
     def _encrypt(self,message): ## openssl ## todo ## remove
         _cmd = shlex.split('openssl enc -aes-256-cbc -md sha256 -iter 10000 -k "secretpassword"',posix=True)
@@ -185,6 +717,10 @@ class checkmk_checker(object):
         return b"03" + _out
 
     def do_checks(self,debug=False,remote_ip=None,**kwargs):
+        _poll_start = time.perf_counter()
+        _poll_cpu = time.process_time()
+        _poll_processes = getattr(self._perf_local,"processes",0)
+        _local_runs = 0
         self._getosinfo()
         _errors = []
         _failed_sections = []
@@ -205,7 +741,9 @@ class checkmk_checker(object):
                 if _name in self.skipcheck:
                     continue
                 try:
-                    _lines += getattr(self,_check)()
+                    _section = self._measure(_check,self._render_section,_name,getattr(self,_check))
+                    if _section:
+                        _lines.append(_section)
                 except:
                     _failed_sections.append(_name)
                     _errors.append(traceback.format_exc())
@@ -217,36 +755,55 @@ class checkmk_checker(object):
                 if _name in self.skipcheck:
                     continue
                 try:
-                    _lines += getattr(self,_check)()
+                    _lines += self._measure(_check,getattr(self,_check))
                 except:
                     _failed_sections.append(_name)
                     _errors.append(traceback.format_exc())
 
         if os.path.isdir(LOCALDIR):
-            for _local_file in glob.glob(f"{LOCALDIR}/**",recursive=True):
-                if os.path.isfile(_local_file) and os.access(_local_file,os.X_OK):
+            _local_runners = []
+            for _local_file in self._get_local_plugins():
+                if os.access(_local_file,os.X_OK):
                     try:
                         _cachetime = int(_local_file.split(os.path.sep)[-2])
                     except:
                         _cachetime = 0
                     try:
-                        _lines.append(self._run_cache_prog(_local_file,_cachetime))
+                        _runner = self._get_cache_runner([_local_file])
+                        _runs = _runner.runs
+                        _runner.start(_cachetime)
+                        _local_runners.append((_runner,_cachetime,os.path.basename(_local_file),_runs))
                     except:
                         _errors.append(traceback.format_exc())
+            _deadline = time.monotonic() + LOCAL_TIMEBUDGET
+            for _runner,_cachetime,_plugin,_runs in _local_runners: ## unfinished plugins return their last output
+                try:
+                    _cpu = time.thread_time()
+                    _output = _runner.collect(_cachetime,timeout=max(0,_deadline - time.monotonic()))
+                    _lines.append(_output)
+                    _local_runs += _runner.runs - _runs
+                    ## the plugin's own runtime, not the time spent waiting on the shared deadline
+                    if _runner.runs:
+                        self._record_perf(f"local:{_plugin}",_runner.duration,time.thread_time() - _cpu,_runner.runs - _runs,len(_output))
+                except:
+                    _errors.append(traceback.format_exc())
 
         if os.path.isdir(SPOOLDIR):
-            _now = time.time()
-            for _filename in glob.glob(f"{SPOOLDIR}/*"):
-                _maxage = re.search("^\d+",_filename)
-
-                if _maxage:
-                    _maxage = int(_maxage.group())
-                    _mtime = os.stat(_filename).st_mtime
-                    if _now - _mtime > _maxage:
-                        continue
-                with open(_filename) as _f:
-                    _lines.append(_f.read())
+            try:
+                _lines += self._measure("spool",self._read_spooldir)
+            except:
+                _errors.append(traceback.format_exc())
 
+        self._record_perf("total",
+            time.perf_counter() - _poll_start,
+            time.process_time() - _poll_cpu, ## all threads of the agent
+            getattr(self._perf_local,"processes",0) - _poll_processes + _local_runs,
+            sum(map(len,_lines)) + len(_lines)
+        )
+        if self.perfsection:
+            _lines += self._perf_lines()
+        if self.memorylimit:
+            _lines += self._memory_lines()
         _lines.append("")
         if debug:
             sys.stdout.write("\n".join(_errors))
@@ -255,9 +812,122 @@ class checkmk_checker(object):
             _lines.append("<<<check_mk>>>")
             _lines.append("FailedPythonPlugins: {0}".format(",".join(_failed_sections)))
 
-        if self.encryptionkey:
-            return self.encrypt("\n".join(_lines),password=self.encryptionkey)
-        return "\n".join(_lines).encode("utf-8")
+        return b"".join(self._output_stream(_lines))
+
+    def _get_local_plugins(self):
+        _directories, _files = self._localdir_cache
+        if _directories and all(map(lambda x: self._watcher.generation(x[0]) == x[1],_directories)):
+            return _files
+        _directories = []
+        _files = []
+        for _root, _subdirs, _filenames in os.walk(LOCALDIR,followlinks=True):
+            _directories.append((_root,self._watcher.generation(_root)))
+            _subdirs[:] = sorted(filter(lambda x: not x.startswith("."),_subdirs))
+            for _filename in sorted(_filenames):
+                _path = os.path.join(_root,_filename)
+                if not _filename.startswith(".") and os.path.isfile(_path):
+                    _files.append(_path)
+        self._localdir_cache = (tuple(_directories),_files)
+        return _files
+
+    def _measure(self,name,func,*args,**kwargs):
+        _processes = getattr(self._perf_local,"processes",0)
+        _wall = time.perf_counter()
+        _cpu = time.thread_time()
+        _ret = func(*args,**kwargs)
+        if type(_ret) == list:
+            _bytes = sum(map(len,_ret)) + len(_ret)
+        else:
+            _bytes = len(_ret) if _ret else 0
+        self._record_perf(name,time.perf_counter() - _wall,time.thread_time() - _cpu,getattr(self._perf_local,"processes",0) - _processes,_bytes)
+        return _ret
+
+    def _record_perf(self,name,wall,cpu,processes,size):
+        if name not in self._perf_data:
+            self._perf_data[name] = collections.deque(maxlen=PERF_SAMPLES)
+        self._perf_data[name].append((wall,cpu,processes,size))
+
+    def _perf_lines(self):
+        _ret = ["<<<checkmk_agent_perf:sep(59)>>>"]
+        _ret.append("section;samples;wall_last;wall_p50;wall_p95;wall_max;cpu_last;subprocesses;bytes")
+        for _name,_samples in sorted(self._perf_data.items()):
+            _wall = sorted(map(lambda x: x[0],_samples))
+            _wall_last, _cpu_last, _processes, _bytes = _samples[-1]
+            _ret.append("{0};{1};{2:.6f};{3:.6f};{4:.6f};{5:.6f};{6:.6f};{7};{8}".format(
+                _name,len(_wall),_wall_last,_wall[int(len(_wall) * 0.5)],_wall[min(len(_wall) - 1,int(len(_wall) * 0.95))],_wall[-1],_cpu_last,_processes,_bytes
+            ))
+        return _ret
+
+    def _get_rss(self):
+        ## peak rss in KiB, without forking ps on every poll, the restart via execv resets it
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    def _memory_lines(self):
+        self._rss = self._get_rss()
+        _ret = ["<<<checkmk_agent_memory:sep(59)>>>"]
+        _ret.append(f"rss;{self._rss}")
+        _ret.append(f"rss_limit;{self.memorylimit * 1024}")
+        _ret.append(f"check_cache;{len(self._check_cache)}")
+        with self._datastore_mutex:
+            _ret.append("datastore;{0}".format(sum(map(len,self._datastore.values()))))
+        _ret.append("certificate_store;{0}".format(len(getattr(self,"_certificate_store",{}))))
+        _ret.append(f"section_cache;{len(self._section_cache)}")
+        _ret.append(f"spool_index;{len(self._spool_index)}")
+        _ret.append(f"perf_data;{len(self._perf_data)}")
+        return _ret
+
+    def _section_signature(self,name):
+        ## input state of sections that only change with it, None runs the check on every poll
+        if name == "label":
+            return "static" ## host facts are read once
+        if name == "dhcp":
+            ## dhcpd runs chrooted, its pidfile is rewritten on restart
+            return tuple(map(lambda x: self._watcher.generation(self._path(x)),("/var/dhcpd/var/db/dhcpd.leases","/var/dhcpd/etc/dhcpd.conf","/var/dhcpd/var/run/dhcpd.pid")))
+        return None
+
+    def _render_section(self,name,check):
+        _now = int(time.time())
+        _signature = self._section_signature(name)
+        _cached = self._section_cache.get(name)
+        _expired = bool(_cached) and _now - _cached[1] >= DELTA_INTERVAL ## full section at least once per interval
+        if _signature == None or not _cached or _cached[3] != _signature or _expired:
+            _lines = check()
+            if not _lines:
+                self._section_cache.pop(name,None)
+                return None
+            _text = "\n".join(_lines)
+            if _signature == None and not self.delta: ## nothing to reuse
+                return _text.encode("utf-8")
+            _hash = hash(_text)
+            if not _cached or _cached[0] != _hash or _expired:
+                _cached = (_hash,_now,_text.encode("utf-8"),_signature)
+            else:
+                _cached = _cached[:3] + (_signature,)
+            self._section_cache[name] = _cached
+        if self.delta and _cached[1] < _now: ## unchanged, cached since the last change
+            return REGEX_SECTION_HEADER.sub(f"<<<\\1:cached({_cached[1]},{DELTA_INTERVAL})>>>",_cached[2].decode("utf-8")).encode("utf-8")
+        return _cached[2]
+
+    def _read_spooldir(self):
+        _now = time.time()
+        _index = {}
+        _ret = []
+        with os.scandir(SPOOLDIR) as _entries:
+            for _entry in sorted(_entries,key=lambda x: x.name):
+                if _entry.name.startswith(".") or not _entry.is_file():
+                    continue
+                _stat = _entry.stat()
+                _maxage = REGEX_SPOOL_MAXAGE.match(_entry.name) ## spoolfile prefixed with maxage in seconds
+                if _maxage and _now - _stat.st_mtime > int(_maxage.group()):
+                    continue
+                _spoolfile = self._spool_index.get(_entry.path)
+                if not _spoolfile or _spoolfile[0] != (_stat.st_mtime_ns,_stat.st_size):
+                    with open(_entry.path) as _f:
+                        _spoolfile = ((_stat.st_mtime_ns,_stat.st_size),_f.read())
+                _index[_entry.path] = _spoolfile
+                _ret.append(_spoolfile[1])
+        self._spool_index = _index ## expired and removed files are dropped
+        return _ret
 
     def _get_storedata(self,section,key):
         with self._datastore_mutex:
@@ -265,35 +935,53 @@ class checkmk_checker(object):
     def _set_storedata(self,section,key,value):
         with self._datastore_mutex:
             if section not in self._datastore:
-                self._datastore[section] = object_dict()
+                self._datastore[section] = bounded_store(maxsize=CACHE_MAXSIZE,ttl=CACHE_TTL)
             self._datastore[section][key] = value
 
-    def _getosinfo(self):
-        _info = json.load(open("/usr/local/opnsense/version/core","r"))
-        _changelog = json.load(open("/usr/local/opnsense/changelog/index.json","r"))
-        _config_modified = os.stat("/conf/config.xml").st_mtime
+    def _get_mtime(self,path):
         try:
-            _latest_firmware = list(filter(lambda x: x.get("series") == _info.get("product_series"),_changelog))[-1]
-            _current_firmware = list(filter(lambda x: x.get("version") == _info.get("product_version").split("_")[0],_changelog))[0].copy() ## not same
-            _current_firmware["age"] = int(time.time() - time.mktime(time.strptime(_current_firmware.get("date"),"%B %d, %Y")))
-            _current_firmware["version"] = _info.get("product_version")
-        except:
-            raise
-            _lastest_firmware = {}
-            _current_firmware = {}
+            return os.stat(self._path(path)).st_mtime_ns
+        except OSError:
+            return None
+
+    def _getosinfo(self):
+        ## sources only change on firmware updates and config applies
+        _sources = tuple(map(self._get_mtime,("/usr/local/opnsense/version/core","/usr/local/opnsense/changelog/index.json","/tmp/pkg_upgrade.json","/conf/config.xml")))
+        if self._osinfo_cache[0] != _sources:
+            self._osinfo_cache = (_sources,self._read_osinfo())
+        _osinfo = self._osinfo_cache[1]
+        _now = time.time()
+        self._info = dict(_osinfo,
+            version_age = int(_now - _osinfo.get("version_date")) if _osinfo.get("version_date") else 0,
+            config_age  = int(_now - _osinfo.get("config_modified"))
+        )
+
+    def _read_osinfo(self):
+        with open(self._path("/usr/local/opnsense/version/core"),"r") as _f:
+            _info = json.load(_f)
+        with open(self._path("/usr/local/opnsense/changelog/index.json"),"r") as _f:
+            _changelog = json.load(_f)
+        _config_modified = os.stat(self._path("/conf/config.xml")).st_mtime
+        ## only the latest release of the series and the installed one are kept
+        _latest_firmware = list(filter(lambda x: x.get("series") == _info.get("product_series"),_changelog))[-1]
+        _current_firmware = list(filter(lambda x: x.get("version") == _info.get("product_version").split("_")[0],_changelog))[0].copy() ## not same
+        del _changelog
+        _current_firmware["version_date"] = time.mktime(time.strptime(_current_firmware.get("date"),"%B %d, %Y"))
+        _current_firmware["version"] = _info.get("product_version")
         try:
-            _upgrade_json = json.load(open("/tmp/pkg_upgrade.json","r"))
-            _upgrade_packages = dict(map(lambda x: (x.get("name"),x),_upgrade_json.get("upgrade_packages")))
-            _current_firmware["version"] = _upgrade_packages.get("opnsense").get("current_version")
-            _latest_firmware["version"] = _upgrade_packages.get("opnsense").get("new_version")
+            with open(self._path("/tmp/pkg_upgrade.json"),"r") as _f:
+                _upgrade_json = json.load(_f)
+            _opnsense_package = next(filter(lambda x: x.get("name") == "opnsense",_upgrade_json.get("upgrade_packages")))
+            _current_firmware["version"] = _opnsense_package.get("current_version")
+            _latest_firmware["version"] = _opnsense_package.get("new_version")
         except:
             _current_firmware["version"] = _current_firmware["version"].split("_")[0]
             _latest_firmware["version"] = _current_firmware["version"] ## fixme ## no upgradepckg error on opnsense ... no new version
-        self._info = {
+        return {
             "os"                : _info.get("product_name"),
             "os_version"        : _current_firmware.get("version"),
-            "version_age"       : _current_firmware.get("age",0),
-            "config_age"        : int(time.time() - _config_modified) ,
+            "version_date"      : _current_firmware.get("version_date"),
+            "config_modified"   : _config_modified,
             "last_configchange" : time.strftime("%H:%M %d.%m.%Y",time.localtime(_config_modified)),
             "product_series"    : _info.get("product_series"),
             "latest_version"    : _latest_firmware.get("version"),
@@ -310,25 +998,34 @@ class checkmk_checker(object):
         return socket.inet_ntoa(struct.pack("!I",intaddr))
 
     def pidof(self,prog,default=None):
-        _allprogs = re.findall("(\w+)\s+(\d+)",self._run_prog("ps ax -c -o command,pid"))
+        _allprogs = REGEX_PIDOF.findall(self._run_prog("ps ax -c -o command,pid"))
         return int(dict(_allprogs).get(prog,default))
 
     def _config_reader(self,config=""):
-        _config = ELementTree.parse("/conf/config.xml")
-        _root = _config.getroot()
-        return etree_to_dict(_root).get("opnsense",{})
+        _generation, _config = self._config_cache
+        if _generation == None or _generation != self._watcher.generation(self._path("/conf/config.xml")):
+            _generation = self._watcher.generation(self._path("/conf/config.xml"))
+            _config = etree_to_dict(ELementTree.parse(self._path("/conf/config.xml")).getroot()).get("opnsense",{})
+            self._config_cache = (_generation,_config)
+        return _config ## shared and read only, callers copy the items they modify
+
+    def _config_changed(self,generation):
+        return generation == None or generation != self._watcher.generation(self._path("/conf/config.xml"))
 
     @staticmethod
     def get_common_name(certrdn):
+        from cryptography import x509
         try:
             return next(filter(lambda x: x.oid == x509.oid.NameOID.COMMON_NAME,certrdn)).value.strip()
         except:
             return str(certrdn)
 
     def _certificate_parser(self):
-        self._certificate_timestamp = time.time()
-        self._certificate_store = {}
-        for _cert in self._config_reader().get("cert"):
+        from cryptography import x509
+        from cryptography.hazmat.backends import default_backend as crypto_default_backend
+        self._certificate_generation = self._watcher.generation(self._path("/conf/config.xml"))
+        self._certificate_store = {} ## rebuilt on every config change, never evicted
+        for _cert in map(dict,self._config_reader().get("cert")):
             try:
                 _certpem = base64.b64decode(_cert.get("crt"))
                 _x509cert = x509.load_pem_x509_certificate(_certpem,crypto_default_backend())
@@ -342,12 +1039,12 @@ class checkmk_checker(object):
             self._certificate_store[_cert.get("refid")] = _cert
             
     def _get_certificate(self,refid):
-        if time.time() - self._certificate_timestamp > 3600:
+        if self._config_changed(self._certificate_generation):
             self._certificate_parser()
         return self._certificate_store.get(refid)
 
     def _get_certificate_by_cn(self,cn,caref=None):
-        if time.time() - self._certificate_timestamp > 3600:
+        if self._config_changed(self._certificate_generation):
             self._certificate_parser()
         if caref:
             _ret = filter(lambda x: x.get("common_name") == cn and x.get("caref") == caref,self._certificate_store.values())
@@ -358,27 +1055,25 @@ class checkmk_checker(object):
         except StopIteration:
             return {}
 
-    def get_opnsense_ipaddr(self):
-        try:
-            _ret = {}
-            for _if,_ip,_mask in re.findall("^([\w_]+):\sflags=(?:8943|8051|8043|8863).*?inet\s([\d.]+)\snetmask\s0x([a-f0-9]+)",self._run_prog("ifconfig"),re.DOTALL | re.M):
-                _ret[_if] = "{0}/{1}".format(_ip,str(bin(int(_mask,16))).count("1"))
-            return _ret
-        except:
-            return {}
-
     def _get_opnsense_ipaddr(self):
-        RE_IPDATA = re.compile("(?P<inet>inet6?)\s(?P<ip>[\da-f:.]+)\/(?P<cidr>\d+).*?(?:vhid\s(?P<vhid>\d+)|$)|carp:\s(?P<carp_status>MASTER|BACKUP)\svhid\s(?P<carp_vhid>\d+)\sadvbase\s(?P<carp_base>\d+)\sadvskew\s(?P<carp_skew>\d)|(vlan):\s(?P<vlan>\d*)",re.DOTALL | re.M)
         try:
             _ret = {}
-            for _if,_data in re.findall("([\w_]+):\s(.*?)\n(?=(?:\w|$))",self._run_prog("ifconfig -f inet:cidr,inet6:cidr"),re.DOTALL | re.M):
-                _ret[_if] = RE_IPDATA.search(_data).groups()
+            for _if,_data in REGEX_IFCONFIG_SHORT.findall(self._run_prog("ifconfig -f inet:cidr,inet6:cidr")):
+                _ret[_if] = REGEX_IPDATA.search(_data).groups()
             return _ret
         except:
             return {}
 
 
     def get_opnsense_interfaces(self):
+        _generation, _ifs = self._opnsense_interfaces
+        if self._config_changed(_generation):
+            _generation = self._watcher.generation(self._path("/conf/config.xml"))
+            _ifs = self._get_opnsense_interfaces()
+            self._opnsense_interfaces = (_generation,_ifs)
+        return dict(_ifs)
+
+    def _get_opnsense_interfaces(self):
         _ifs = {}
         #pprint(self._config_reader().get("interfaces"))
         #sys.exit(0)
@@ -409,37 +1104,46 @@ class checkmk_checker(object):
             return ["1 Firmware update_available=1|last_updated={version_age:.0f}|apply_finish_time={config_age:.0f} Version {os_version} ({latest_version} available {latest_date}) Config changed: {last_configchange}".format(**self._info)]
         return ["0 Firmware update_available=0|last_updated={version_age:.0f}|apply_finish_time={config_age:.0f} Version {os_version}  Config changed: {last_configchange}".format(**self._info)]
 
+    def _get_host_facts(self):
+        ## static for the lifetime of the daemon
+        if self._host_facts == None:
+            _facts = {}
+            for _line in self._run_prog("sysctl -q kern.vm_guest hw.model hw.ncpu hw.pagesize hw.physmem",ignore_error=True).split("\n"):
+                _key, _sep, _value = _line.partition(": ")
+                if _sep:
+                    _facts[_key.strip()] = _value.strip()
+            self._host_facts = {
+                "vm_guest"  : _facts.get("kern.vm_guest","none"),
+                "cpu_model" : _facts.get("hw.model",""),
+                "ncpu"      : int(_facts.get("hw.ncpu") or 1),
+                "pagesize"  : int(_facts.get("hw.pagesize") or 4096),
+                "physmem"   : int(_facts.get("hw.physmem") or 0)
+            }
+        return self._host_facts
+
     def check_label(self):
+        _facts = self._get_host_facts()
         _ret = ["<<<labels:sep(0)>>>"]
-        _dmsg = self._run_prog("dmesg",timeout=10)
-        if _dmsg.lower().find("hypervisor:") > -1:
+        if _facts.get("vm_guest") not in ("none",""):
             _ret.append('{"cmk/device_type":"vm"}')
+            _ret.append(json.dumps({"opnsense/hypervisor": _facts.get("vm_guest")},separators=(",",":")))
+        if _facts.get("cpu_model"):
+            _ret.append(json.dumps({"opnsense/cpu_model": _facts.get("cpu_model")},separators=(",",":")))
+        _ret.append(json.dumps({"opnsense/cpu_cores": str(_facts.get("ncpu"))},separators=(",",":")))
         return _ret
 
     def check_net(self):
         _now = int(time.time())
         _opnsense_ifs = self.get_opnsense_interfaces()
         _ret = ["<<<statgrab_net>>>"]
-        _interface_data = []
-        _interface_data = self._run_prog("/usr/bin/netstat -i -b -d -n -W -f link").split("\n")
-        _header = _interface_data[0].lower()
-        _header = _header.replace("pkts","packets").replace("coll","collisions").replace("errs","error").replace("ibytes","rx").replace("obytes","tx")
-        _header = _header.split()
-        _interface_stats = dict(
-            map(
-                lambda x: (x.get("name"),x),
-                [
-                    dict(zip(_header,_ifdata.split()))
-                    for _ifdata in _interface_data[1:] if _ifdata
-                ]
-            )
-        )
-
+        _interface_stats = self._get_interface_stats()
         _ifconfig_out = self._run_prog("ifconfig -m -v -f inet:cidr,inet6:cidr")
         _ifconfig_out += "END" ## fix regex
-        self._all_interfaces = object_dict()
-        self._carp_interfaces = object_dict()
-        for _interface, _data in re.findall("^(?P<iface>[\w.]+):\s(?P<data>.*?(?=^\w))",_ifconfig_out,re.DOTALL | re.MULTILINE):
+        ## built locally and swapped in at the end, realtime checks read them concurrently
+        _all_interfaces = object_dict()
+        _carp_interfaces = object_dict()
+        _net_interfaces = []
+        for _interface, _data in REGEX_IFCONFIG.findall(_ifconfig_out):
             _interface_dict = object_dict()
             _interface_dict.update(_interface_stats.get(_interface,{}))
             _interface_dict["interface_name"] = _opnsense_ifs.get(_interface,_interface)
@@ -447,9 +1151,9 @@ class checkmk_checker(object):
             #if _interface.startswith("vmx"): ## vmware fix 10GBe (as OS Support)
             #    _interface_dict["speed"] = "10000"
             _interface_dict["systime"] = _now
-            for _key, _val in re.findall("^\s*(\w+)[:\s=]+(.*?)$",_data,re.MULTILINE):
+            for _key, _val in REGEX_IFCONFIG_KEYVALUE.findall(_data):
                 if _key == "description":
-                   _interface_dict["interface_name"] = re.sub("_\((lan|wan|opt\d)\)","",_val.strip().replace(" ","_"))
+                   _interface_dict["interface_name"] = REGEX_IF_DESCRIPTION.sub("",_val.strip().replace(" ","_"))
                 if _key == "groups":
                     _interface_dict["groups"] = _val.strip().split()
                 if _key == "ether":
@@ -459,7 +1163,7 @@ class checkmk_checker(object):
                 if _interface.startswith("wg") and _interface_dict.get("flags",0) & 0x01:
                     _interface_dict["up"] = "true"
                 if _key == "flags":
-                    _interface_dict["flags"] = int(re.findall("^[a-f\d]+",_val)[0],16)
+                    _interface_dict["flags"] = int(REGEX_IF_FLAGS.findall(_val)[0],16)
                     ## hack pppoe no status active or pppd pid
                     if _interface.lower().startswith("pppoe") and _interface_dict["flags"] & 0x10 and _interface_dict["flags"] & 0x1: 
                         _interface_dict["up"] = "true"
@@ -473,21 +1177,22 @@ class checkmk_checker(object):
                     ## 0x800 SIMPLEX
                     ## 0x8000 MULTICAST
                 if _key == "media":
-                    _match = re.search("\((?P<speed>\d+G?)base(?:.*?<(?P<duplex>.*?)>)?",_val)
+                    _match = REGEX_IF_MEDIA.search(_val)
                     if _match:
                         _interface_dict["speed"] = _match.group("speed").replace("G","000")
                         _interface_dict["duplex"] = _match.group("duplex")
                 if _key == "inet":
-                    _match = re.search("^(?P<ipaddr>[\d.]+)\/(?P<cidr>\d+).*?(?:vhid\s(?P<vhid>\d+)|$)",_val,re.M)
+                    _match = REGEX_IF_INET.search(_val)
                     if _match:
                         _cidr = _match.group("cidr")
                         _ipaddr = _match.group("ipaddr")
                         _vhid = _match.group("vhid")
                         if not _vhid:
                             _interface_dict["cidr"] = _cidr ## cidr wenn kein vhid
+                            _interface_dict.setdefault("ipaddr",_ipaddr)
                         ## fixme ipaddr dict / vhid dict
                 if _key == "inet6":
-                    _match = re.search("^(?P<ipaddr>[0-9a-f:]+)\/(?P<prefix>\d+).*?(?:vhid\s(?P<vhid>\d+)|$)",_val,re.M)
+                    _match = REGEX_IF_INET6.search(_val)
                     if _match:
                         _ipaddr = _match.group("ipaddr")
                         _prefix = _match.group("prefix")
@@ -496,16 +1201,16 @@ class checkmk_checker(object):
                             _interface_dict["prefix"] = _prefix
                         ## fixme ipaddr dict / vhid dict
                 if _key == "carp":
-                    _match = re.search("(?P<status>MASTER|BACKUP)\svhid\s(?P<vhid>\d+)\sadvbase\s(?P<base>\d+)\sadvskew\s(?P<skew>\d+)",_val,re.M)
+                    _match = REGEX_IF_CARP.search(_val)
                     if _match:
                         _carpstatus = _match.group("status")
                         _vhid = _match.group("vhid")
-                        self._carp_interfaces[_vhid] = (_interface,_carpstatus)
+                        _carp_interfaces[_vhid] = (_interface,_carpstatus)
                         _advbase = _match.group("base")
                         _advskew = _match.group("skew")
                         ## fixme vhid dict
                 if _key == "id":
-                    _match = re.search("priority\s(\d+)",_val)
+                    _match = REGEX_IF_BRIDGE_PRIORITY.search(_val)
                     if _match:
                         _interface_dict["bridge_prio"] = _match.group(1)
                 if _key == "member":
@@ -521,18 +1226,56 @@ class checkmk_checker(object):
                         pass
 
             if _interface_dict["flags"] & 0x2 or _interface_dict["flags"] & 0x10 or _interface_dict["flags"] & 0x80: ## nur broadcast oder ptp
-                self._all_interfaces[_interface] = _interface_dict
+                _all_interfaces[_interface] = _interface_dict
             else:
                 continue
             #if re.search("^[*]?(pflog|pfsync|lo)\d?",_interface):
             #    continue
             if not _opnsense_ifs.get(_interface):
                 continue
-            for _key,_val in _interface_dict.items():
-                if _key in ("mtu","ipackets","ierror","idrop","rx","opackets","oerror","tx","collisions","drop","interface_name","up","systime","phys_address","speed","duplex"):
-                    if type(_val) in (str,int,float):
-                        _ret.append(f"{_interface}.{_key} {_val}")
+            _net_interfaces.append(_interface)
+            _ret += self._format_net_interface(_interface,_interface_dict)
+
+        self._all_interfaces = _all_interfaces
+        self._carp_interfaces = _carp_interfaces
+        self._net_interfaces = _net_interfaces
+        return _ret
+
+    def _get_interface_stats(self):
+        _interface_data = self._run_prog("/usr/bin/netstat -i -b -d -n -W -f link").split("\n")
+        _header = _interface_data[0].lower()
+        _header = _header.replace("pkts","packets").replace("coll","collisions").replace("errs","error").replace("ibytes","rx").replace("obytes","tx")
+        _header = _header.split()
+        return dict(
+            map(
+                lambda x: (x.get("name"),x),
+                [
+                    dict(zip(_header,_ifdata.split()))
+                    for _ifdata in _interface_data[1:] if _ifdata
+                ]
+            )
+        )
+
+    @staticmethod
+    def _format_net_interface(interface,interface_dict):
+        _ret = []
+        for _key,_val in interface_dict.items():
+            if _key in ("mtu","ipackets","ierror","idrop","rx","opackets","oerror","tx","collisions","drop","interface_name","up","systime","phys_address","speed","duplex"):
+                if type(_val) in (str,int,float):
+                    _ret.append(f"{interface}.{_key} {_val}")
+        return _ret
 
+    def _realtime_net(self):
+        ## only counters are refreshed, everything else from the last check_net
+        _now = int(time.time())
+        _interface_stats = self._get_interface_stats()
+        _all_interfaces, _net_interfaces = self._all_interfaces, self._net_interfaces ## check_net swaps in new objects, never fills these
+        _ret = ["<<<statgrab_net>>>"]
+        for _interface in _net_interfaces:
+            _interface_dict = dict(_all_interfaces.get(_interface,{}))
+            _interface_dict.update(_interface_stats.get(_interface,{}))
+            _interface_dict["systime"] = _now
+            _ret += self._format_net_interface(_interface,_interface_dict)
         return _ret
 
     def checklocal_services(self):
@@ -579,21 +1322,21 @@ class checkmk_checker(object):
         return _ret
 
     def check_dhcp(self):
-        if not os.path.exists("/var/dhcpd/var/db/dhcpd.leases"):
+        if not os.path.exists(self._path("/var/dhcpd/var/db/dhcpd.leases")):
             return []
         _ret = ["<<<isc_dhcpd>>>"]
         _ret.append("[general]\nPID: {0}".format(self.pidof("dhcpd",-1)))
         
-        _dhcpleases = open("/var/dhcpd/var/db/dhcpd.leases","r").read()
+        _dhcpleases = open(self._path("/var/dhcpd/var/db/dhcpd.leases"),"r").read()
         ## FIXME 
         #_dhcpleases_dict = dict(map(lambda x: (self.ip2int(x[0]),x[1]),re.findall(r"lease\s(?P<ipaddr>[0-9.]+)\s\{.*?.\n\s+binding state\s(?P<state>\w+).*?\}",_dhcpleases,re.DOTALL)))
-        _dhcpleases_dict = dict(re.findall(r"lease\s(?P<ipaddr>[0-9.]+)\s\{.*?.\n\s+binding state\s(?P<state>active).*?\}",_dhcpleases,re.DOTALL))
-        _dhcpconf = open("/var/dhcpd/etc/dhcpd.conf","r").read()
+        _dhcpleases_dict = dict(REGEX_DHCP_LEASE.findall(_dhcpleases))
+        _dhcpconf = open(self._path("/var/dhcpd/etc/dhcpd.conf"),"r").read()
         _ret.append("[pools]")
-        for _subnet in re.finditer(r"subnet\s(?P<subnet>[0-9.]+)\snetmask\s(?P<netmask>[0-9.]+)\s\{.*?(?:pool\s\{.*?\}.*?)*}",_dhcpconf,re.DOTALL):
+        for _subnet in REGEX_DHCP_SUBNET.finditer(_dhcpconf):
             #_cidr = bin(self.ip2int(_subnet.group(2))).count("1")
             #_available = 0
-            for _pool in re.finditer("pool\s\{.*?range\s(?P<start>[0-9.]+)\s(?P<end>[0-9.]+).*?\}",_subnet.group(0),re.DOTALL):
+            for _pool in REGEX_DHCP_POOL.finditer(_subnet.group(0)):
                 #_start,_end = self.ip2int(_pool.group(1)), self.ip2int(_pool.group(2))
                 #_ips_in_pool = filter(lambda x: _start < x[0] < _end,_dhcpleases_dict.items())
                 #pprint(_dhcpleases_dict)
@@ -643,6 +1386,63 @@ class checkmk_checker(object):
             _sock = None
         return ""
 
+    @staticmethod
+    def _iter_openvpnsocket(vpnsocket,cmd,timeout=10):
+        ## line by line reply without buffering the whole client list
+        _deadline = time.monotonic() + timeout
+        _sock = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        _sock.settimeout(timeout)
+        try:
+            _sock.connect(vpnsocket)
+            _reader = _sock.makefile("rb")
+            assert _reader.readline().startswith(b">INFO")
+            _sock.send((cmd.strip() + "\n").encode("utf-8"))
+            while True:
+                _sock.settimeout(max(0.001,_deadline - time.monotonic())) ## deadline for the whole reply
+                _line = _reader.readline()
+                if not _line:
+                    break
+                _line = _line.rstrip(b"\r\n").decode("utf-8")
+                if _line == "END" or _line.startswith("ERROR:"):
+                    break
+                yield _line
+        except socket.timeout: ## hanging management socket, no (more) data
+            return
+        finally:
+            try:
+                _sock.send("quit\n".encode("utf-8"))
+            except OSError:
+                pass
+            _sock.close()
+
+    @staticmethod
+    def _parse_openvpn_status(lines,servername,monitored_clients,now):
+        ## status 3: CLIENT_LIST cn real_addr vpn_ip vpn_ipv6 bytes_recv bytes_sent since since_t username clientid peerid cipher
+        _number_of_clients = 0
+        for _line in lines:
+            if not _line.startswith("CLIENT_LIST\t"):
+                continue
+            _number_of_clients += 1
+            _fields = _line.split("\t")
+            _username = _fields[9] if _fields[9] != "UNDEF" else _fields[1]
+            _client = monitored_clients.get(_username.upper())
+            if _client is None:
+                continue
+            _client["current"].append({
+                "server"         : servername,
+                "common_name"    : _fields[1],
+                "remote_ip"      : _fields[2].rsplit(":",1)[0], ## ipv6
+                "vpn_ip"         : _fields[3],
+                "vpn_ipv6"       : _fields[4],
+                "bytes_received" : int(_fields[5]),
+                "bytes_sent"     : int(_fields[6]),
+                "uptime"         : now - int(_fields[8]),
+                "username"       : _username,
+                "clientid"       : int(_fields[10]),
+                "cipher"         : _fields[12]
+            })
+        return _number_of_clients
+
     def _get_traffic(self,modul,interface,totalbytesin,totalbytesout):
         _hist_data = self._get_storedata(modul,interface)
         _slot = int(time.time())
@@ -657,20 +1457,73 @@ class checkmk_checker(object):
             self._set_storedata(modul,interface,(_slot,totalbytesin,totalbytesout))
         return _traffic_in,_traffic_out
 
+    def _get_counter_deltas(self,modul,key,counters):
+        ## deltas to the last poll, empty if there is no history or a counter was reset
+        _now = time.time()
+        _hist_data = self._get_storedata(modul,key)
+        self._set_storedata(modul,key,(_now,counters))
+        if not _hist_data or _now - _hist_data[0] <= 0:
+            return 0,{}
+        _delta = dict(map(lambda x: (x[0],x[1] - _hist_data[1].get(x[0],0)),counters.items()))
+        if min(_delta.values(),default=0) < 0:
+            return 0,{}
+        return _now - _hist_data[0],_delta
+
     @staticmethod
-    def _get_dpinger_gateway(gateway):
-        _path = "/var/run/dpinger_{0}.sock".format(gateway)
-        if os.path.exists(_path):
-            _sock = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
-            try:
-                _sock.connect(_path)
-                _data = _sock.recv(1024).decode("utf-8").strip()
-                _name, _rtt, _rttsd, _loss = re.findall("(\w+)\s(\d+)\s(\d+)\s(\d+)$",_data)[0]
-                assert _name.strip() == gateway
-                return int(_rtt)/1_000_000.0,int(_rttsd)/1_000_000.0, int(_loss)
-            except:
-                raise
-        return -1,-1,-1
+    def _get_dpinger_gateways(gateways,timeout=5):
+        _ret = dict(map(lambda x: (x,(-1,-1,-1)),gateways))
+        _selector = selectors.DefaultSelector()
+        _buffers = {}
+        try:
+            for _gateway in gateways:
+                _path = "/var/run/dpinger_{0}.sock".format(_gateway)
+                if not os.path.exists(_path):
+                    continue
+                _sock = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+                _sock.setblocking(False)
+                try:
+                    _sock.connect(_path)
+                except (BlockingIOError,InterruptedError):
+                    pass
+                except OSError:
+                    _sock.close()
+                    continue
+                _selector.register(_sock,selectors.EVENT_READ,(_gateway,time.monotonic() + timeout))
+                _buffers[_gateway] = b""
+
+            while _selector.get_map():
+                _now = time.monotonic()
+                for _key in list(_selector.get_map().values()): ## per socket deadline
+                    if _key.data[1] <= _now:
+                        _selector.unregister(_key.fileobj)
+                        _key.fileobj.close()
+                if not _selector.get_map():
+                    break
+                _wait = min(map(lambda x: x.data[1],_selector.get_map().values())) - _now
+                for _key,_ in _selector.select(max(0,_wait)):
+                    _gateway = _key.data[0]
+                    try:
+                        _data = _key.fileobj.recv(1024)
+                    except BlockingIOError:
+                        continue
+                    except OSError:
+                        _data = b""
+                    _buffers[_gateway] += _data
+                    if _data and b"\n" not in _data:
+                        continue
+                    _selector.unregister(_key.fileobj)
+                    _key.fileobj.close()
+                    try:
+                        _name, _rtt, _rttsd, _loss = REGEX_DPINGER.findall(_buffers[_gateway].decode("utf-8").strip())[0]
+                        if _name.strip() == _gateway:
+                            _ret[_gateway] = (int(_rtt)/1_000_000.0,int(_rttsd)/1_000_000.0, int(_loss))
+                    except (IndexError,UnicodeDecodeError):
+                        pass
+        finally:
+            for _key in list(_selector.get_map().values()):
+                _key.fileobj.close()
+            _selector.close()
+        return _ret
 
     def checklocal_gateway(self):
         _ret = []
@@ -681,19 +1534,25 @@ class checkmk_checker(object):
         if type(_gateway_items) != list:
             _gateway_items = [_gateway_items] if _gateway_items else []
         _interfaces = self._config_reader().get("interfaces",{})
-        _ipaddresses = self.get_opnsense_ipaddr()
+        _gateway_items = list(map(dict,filter(lambda x: x.get("monitor_disable") != "1" and x.get("disabled") != "1",_gateway_items)))
+        _dpinger = self._get_dpinger_gateways(list(map(lambda x: x.get("name"),_gateway_items)))
+        _ipaddrs = None
         for _gateway in _gateway_items:
             if type(_gateway.get("descr")) != str:
                 _gateway["descr"] = _gateway.get("name")
-            if _gateway.get("monitor_disable") == "1" or _gateway.get("disabled") == "1":
-                continue
             _interface = _interfaces.get(_gateway.get("interface"),{})
             _gateway["realinterface"] = _interface.get("if")
-            if _gateway.get("ipprotocol") == "inet":
-                _gateway["ipaddr"] = _ipaddresses.get(_interface.get("if"))
-            else:
-                _gateway["ipaddr"] = ""
-            _gateway["rtt"], _gateway["rttsd"], _gateway["loss"] = self._get_dpinger_gateway(_gateway.get("name"))
+            _gateway["ipaddr"] = ""
+            _ifdata = self._all_interfaces.get(_interface.get("if"),{})
+            if _gateway.get("ipprotocol") == "inet" and _ifdata.get("ipaddr"):
+                _gateway["ipaddr"] = "{ipaddr}/{cidr}".format(**_ifdata)
+            elif _gateway.get("ipprotocol") == "inet" and not self._all_interfaces: ## check_net skipped or not run yet
+                if _ipaddrs == None:
+                    _ipaddrs = self._get_opnsense_ipaddr()
+                _ipdata = _ipaddrs.get(_interface.get("if"))
+                if _ipdata and _ipdata[0] == "inet":
+                    _gateway["ipaddr"] = "{1}/{2}".format(*_ipdata)
+            _gateway["rtt"], _gateway["rttsd"], _gateway["loss"] = _dpinger.get(_gateway.get("name"),(-1,-1,-1))
             _gateway["status"] = 0
             if _gateway.get("loss") > 0 or _gateway.get("rtt") > 100:
                 _gateway["status"] = 1
@@ -703,6 +1562,48 @@ class checkmk_checker(object):
             _ret.append("{status} \"Gateway {descr}\" rtt={rtt}|rttsd={rttsd}|loss={loss} Gateway on Interface: {realinterface} {gateway}".format(**_gateway))
         return _ret
 
+    def checklocal_pf(self):
+        _info, _limits = self._run_progs("pfctl -si -v","pfctl -sm",timeout=10,ignore_error=True)
+        if not _info.strip():
+            return []
+        _pf = {}
+        _section = ""
+        for _line in _info.split("\n"):
+            if _line and not _line[0].isspace():
+                _section = _line.split("  ")[0].strip().lower()
+                continue
+            _match = REGEX_PFCTL_COUNTER.match(_line)
+            if _match:
+                _pf[f"{_section}:{_match.group('name').lower()}"] = int(_match.group("value"))
+        _limits = dict(map(lambda x: (x[0],int(x[1])),REGEX_PFCTL_LIMIT.findall(_limits)))
+
+        _states = _pf.get("state table:current entries",0)
+        _limit = _limits.get("states",0)
+        _warn, _crit = int(_limit * 0.8), int(_limit * 0.9)
+        _counters = dict(filter(lambda x: x[0].startswith("state table:") or x[0].startswith("counters:"),_pf.items()))
+        _counters.pop("state table:current entries",None)
+        _interval, _delta = self._get_counter_deltas("pf","counters",_counters)
+        _rates = dict(map(lambda x: (x,_delta.get(x,0) / _interval if _delta else 0),_counters.keys()))
+
+        _status = 0
+        _text = [f"{_states}/{_limit} states"]
+        if _limit and _states >= _crit:
+            _status = 2
+        elif _limit and _states >= _warn:
+            _status = 1
+        for _problem in ("counters:memory","counters:state-limit","counters:state-insert"):
+            if _delta.get(_problem,0) > 0:
+                _status = max(_status,1)
+                _text.append("{0} {1}".format(_problem.split(":")[1],_delta.get(_problem)))
+        _perfdata = [f"pf_states={_states};{_warn};{_crit};0;{_limit}"]
+        _perfdata.append("pf_state_inserts={0:.2f}".format(_rates.get("state table:inserts",0)))
+        _perfdata.append("pf_state_removals={0:.2f}".format(_rates.get("state table:removals",0)))
+        _perfdata.append("pf_searches={0:.2f}".format(_rates.get("state table:searches",0)))
+        for _key,_rate in sorted(_rates.items()):
+            if _key.startswith("counters:"):
+                _perfdata.append("pf_{0}={1:.2f}".format(_key.split(":",1)[1].replace("-","_"),_rate))
+        return ["{0} \"PF States\" {1} {2}".format(_status,"|".join(_perfdata),", ".join(_text))]
+
     def checklocal_openvpn(self):
         _ret = []
         _cfr = self._config_reader().get("openvpn")
@@ -723,7 +1624,7 @@ class checkmk_checker(object):
             _vpnserver = [_vpnserver] if _vpnserver else []
         if type(_vpnclient) != list:
             _vpnclient = [_vpnclient] if _vpnclient else []
-        for _server in _vpnserver + _vpnclient:
+        for _server in map(dict,_vpnserver + _vpnclient):
             ## server_tls, p2p_shared_key p2p_tls
             _server["name"] = _server.get("description").strip() if _server.get("description") else "OpenVPN_{protocoll}_{local_port}".format(**_server)
 
@@ -748,7 +1649,7 @@ class checkmk_checker(object):
                     
                     _server["bytesin"], _server["bytesout"] = self._get_traffic("openvpn",
                         "SRV_{name}".format(**_server),
-                        *(map(lambda x: int(x),re.findall("bytes\w+=(\d+)",self._read_from_openvpnsocket(_unix,"load-stats"))))
+                        *(map(lambda x: int(x),REGEX_OPENVPN_BYTES.findall(self._read_from_openvpnsocket(_unix,"load-stats"))))
                     )
                     _laststate = self._read_from_openvpnsocket(_unix,"state 1").strip().split("\r\n")[-2]
                     _timestamp, _server["connstate"], _data = _laststate.split(",",2)
@@ -759,7 +1660,7 @@ class checkmk_checker(object):
                         _server["remote_port"] = _data[3]
                         _server["source_addr"] = _data[4]
                         _server["status"] = 0 if _server["status"] == 3 else _server["status"]
-                        _ret.append('{status} "OpenVPN Connection: {name}" connections_ssl_vpn=1;;|if_in_octets={bytesin}|if_out_octets={bytesout}|expiredays={expiredays} Connected {remote_ipaddr}:{remote_port} {vpn_ipaddr} {expiredate}\Source IP: {source_addr}'.format(**_server))
+                        _ret.append(r'{status} "OpenVPN Connection: {name}" connections_ssl_vpn=1;;|if_in_octets={bytesin}|if_out_octets={bytesout}|expiredays={expiredays} Connected {remote_ipaddr}:{remote_port} {vpn_ipaddr} {expiredate}\Source IP: {source_addr}'.format(**_server))
                     else:
                         if _server["type"] == "client":
                             _server["status"] = 2
@@ -782,36 +1683,19 @@ class checkmk_checker(object):
                         
                         _server["bytesin"], _server["bytesout"] = self._get_traffic("openvpn",
                             "SRV_{name}".format(**_server),
-                            *(map(lambda x: int(x),re.findall("bytes\w+=(\d+)",self._read_from_openvpnsocket(_unix,"load-stats"))))
+                            *(map(lambda x: int(x),REGEX_OPENVPN_BYTES.findall(self._read_from_openvpnsocket(_unix,"load-stats"))))
                         )
                         _server["status"] = 0 if _server["status"] == 3 else _server["status"]
                     except:
                         _server["bytesin"], _server["bytesout"] = 0,0
                         raise
                     
-                    _number_of_clients = 0
-                    _now = int(time.time())
-                    _response = self._read_from_openvpnsocket(_unix,"status 2")
-                    for _client_match in re.finditer("^CLIENT_LIST,(.*?)$",_response,re.M):
-                        _number_of_clients += 1
-                        _client_raw = list(map(lambda x: x.strip(),_client_match.group(1).split(",")))
-                        _client = {
-                            "server"         : _server.get("name"),
-                            "common_name"    : _client_raw[0],
-                            "remote_ip"      : _client_raw[1].rsplit(":",1)[0], ## ipv6
-                            "vpn_ip"         : _client_raw[2],
-                            "vpn_ipv6"       : _client_raw[3],
-                            "bytes_received" : int(_client_raw[4]),
-                            "bytes_sent"     : int(_client_raw[5]),
-                            "uptime"         : _now - int(_client_raw[7]),
-                            "username"       : _client_raw[8] if _client_raw[8] != "UNDEF" else _client_raw[0],
-                            "clientid"       : int(_client_raw[9]),
-                            "cipher"         : _client_raw[11].strip("\r\n")
-                        }
-                        if _client["username"].upper() in _monitored_clients:
-                            _monitored_clients[_client["username"].upper()]["current"].append(_client)
-
-                    _server["clientcount"] = _number_of_clients
+                    _server["clientcount"] = self._parse_openvpn_status(
+                        self._iter_openvpnsocket(_unix,"status 3"),
+                        _server.get("name"),
+                        _monitored_clients,
+                        int(time.time())
+                    )
                     _ret.append('{status} "OpenVPN Server: {name}" connections_ssl_vpn={clientcount};;{maxclients}|if_in_octets={bytesin}|if_out_octets={bytesout}|expiredays={expiredays} {clientcount}/{maxclients} Connections Port:{local_port}/{protocol} {expiredate}'.format(**_server))
                 except:
                     _ret.append('2 "OpenVPN Server: {name}" connections_ssl_vpn=0;;{maxclients}|expiredays={expiredays}|if_in_octets=0|if_out_octets=0| Server down Port:{local_port}/{protocol} {expiredate}'.format(**_server))
@@ -853,6 +1737,30 @@ class checkmk_checker(object):
                 _ret.append('{status} "OpenVPN Client: {description}" connectiontime=0|connections_ssl_vpn=0|if_in_octets=0|if_out_octets=0|expiredays={expiredays} Nicht verbunden {expiredate}'.format(**_client))
         return _ret
 
+    def _get_ipsec_status(self):
+        if not os.path.exists(VICI_SOCKET):
+            _json_data = self._run_prog("/usr/local/opnsense/scripts/ipsec/list_status.py")
+            if len(_json_data.strip()) < 20:
+                return {}
+            return json.loads(_json_data)
+        _ret = {}
+        with vici_session() as _vici:
+            for _conn in _vici.streamed_request("list-conns","list-conn"):
+                for _conid,_condata in _conn.items():
+                    _ret[_conid] = { "local-id" : "", "remote-id" : "", "sas" : [] }
+                    for _key,_val in _condata.items():
+                        if type(_val) != dict:
+                            continue
+                        if _key.startswith("local"):
+                            _ret[_conid]["local-id"] = _val.get("id","")
+                        elif _key.startswith("remote"):
+                            _ret[_conid]["remote-id"] = _val.get("id","")
+            for _sa in _vici.streamed_request("list-sas","list-sa"):
+                for _conid,_sadata in _sa.items():
+                    if _conid in _ret:
+                        _ret[_conid]["sas"].append(_sadata)
+        return _ret
+
     def checklocal_ipsec(self):
         _ret = []
         _ipsec_config = self._config_reader().get("ipsec")
@@ -860,21 +1768,19 @@ class checkmk_checker(object):
             return []
         _phase1config = _ipsec_config.get("phase1")
         if type(_phase1config) != list:
-            _phase1config = [_phase1config]
-        _json_data = self._run_prog("/usr/local/opnsense/scripts/ipsec/list_status.py")
-        if len(_json_data.strip()) < 20:
-            return []
-        for _conid,_con in json.loads(_json_data).items():
-            _conid = _conid[3:]
-            try:
-                _config = next(filter(lambda x: x.get("ikeid") == _conid,_phase1config))
-            except StopIteration:
+            _phase1config = [_phase1config] if _phase1config else []
+        _phase1config = dict(map(lambda x: (x.get("ikeid"),x),_phase1config))
+        for _conid,_con in self._get_ipsec_status().items():
+            _config = _phase1config.get(_conid[3:])
+            if not _config:
                 continue
-            _childsas = None
             _con["status"] = 2
             _con["bytes_received"] = 0
             _con["bytes_sent"] = 0
+            _con["life-time"] = 0
+            _con["childsas"] = 0
             _con["remote-host"] = "unknown"
+            _con["remote-name"] = _config.get("descr",_con.get("remote-id"))
             for _sas in _con.get("sas",[]):
                 _con["state"] = _sas.get("state","unknown")
                 if not _con["local-id"]:
@@ -886,26 +1792,25 @@ class checkmk_checker(object):
                     _con["remote-id"] = _sas.get("remote-id")
                     _con["state"] = "ABANDOMED"
 
-                _childsas = filter(lambda x: x.get("state") == "INSTALLED",_sas.get("child-sas").values())
-                _con["remote-name"] = _config.get("descr",_con.get("remote-id"))
-
-                try:
-                    _childsas = next(_childsas)
+                for _childsa in filter(lambda x: x.get("state") == "INSTALLED",_sas.get("child-sas",{}).values()):
                     _con["remote-host"] = _sas.get("remote-host")
-                    _connecttime = max(1,int(_childsas.get("install-time",0)))
-                    _con["bytes_received"] = int(int(_childsas.get("bytes-in",0)) /_connecttime)
-                    _con["bytes_sent"] = int(int(_childsas.get("bytes-out",0)) / _connecttime)
-                    _con["life-time"] = int(_childsas.get("life-time",0))
-
-                    _con["status"] = 0 if _con["status"] == 2 else 1
-                    break
-                except StopIteration:
-                    pass
+                    ## rate per child sa uniqueid, a rekeyed child starts a new counter
+                    _bytes_received, _bytes_sent = self._get_traffic("ipsec",
+                        "SA_{0}".format(_childsa.get("uniqueid",_childsa.get("reqid"))),
+                        int(_childsa.get("bytes-in",0)),
+                        int(_childsa.get("bytes-out",0))
+                    )
+                    _con["bytes_received"] += int(_bytes_received)
+                    _con["bytes_sent"] += int(_bytes_sent)
+                    _con["life-time"] = max(_con["life-time"],int(_childsa.get("life-time",0)))
+                    _con["childsas"] += 1
+            if _con["childsas"]:
+                _con["status"] = 0 if _con["status"] == 2 else 1
             try:
-                if _childsas:
-                    _ret.append("{status} \"IPsec Tunnel: {remote-name}\" if_in_octets={bytes_received}|if_out_octets={bytes_sent}|lifetime={life-time} {state} {local-id} - {remote-id}({remote-host})".format(**_con))
+                if _con["childsas"]:
+                    _ret.append("{status} \"IPsec Tunnel: {remote-name}\" if_in_octets={bytes_received}|if_out_octets={bytes_sent}|lifetime={life-time}|childsas={childsas} {state} {local-id} - {remote-id}({remote-host})".format(**_con))
                 else:
-                    _ret.append("{status} \"IPsec Tunnel: {remote-name}\" if_in_octets=0|if_out_octets=0|lifetime=0 not connected {local-id} - {remote-id}({remote-host})".format(**_con))
+                    _ret.append("{status} \"IPsec Tunnel: {remote-name}\" if_in_octets=0|if_out_octets=0|lifetime=0|childsas=0 not connected {local-id} - {remote-id}({remote-host})".format(**_con))
             except KeyError: ##fixme error melden
                 continue
         return _ret
@@ -916,7 +1821,7 @@ class checkmk_checker(object):
             _clients = self._config_reader().get("OPNsense").get("wireguard").get("client").get("clients").get("client")
             if type(_clients) != list:
                 _clients = [_clients] if _clients else []
-            _clients = dict(map(lambda x: (x.get("pubkey"),x),_clients))
+            _clients = dict(map(lambda x: (x.get("pubkey"),dict(x)),_clients))
         except:
             return []
 
@@ -950,17 +1855,97 @@ class checkmk_checker(object):
 
         return _ret
 
+    def _read_unbound_socket(self,command,config="/var/unbound/unbound.conf"):
+        with open(self._path(config),"r") as _f:
+            _control = dict(REGEX_UNBOUND_CONTROL.findall(_f.read()))
+        if _control.get("control-enable","no") != "yes":
+            raise ConnectionError("unbound remote-control disabled")
+        _interface = _control.get("control-interface","127.0.0.1")
+        if _interface.startswith("/"):
+            _sock = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+            _address = _interface
+        elif _control.get("control-use-cert","yes") == "no":
+            _sock = socket.socket(socket.AF_INET6 if ":" in _interface else socket.AF_INET,socket.SOCK_STREAM)
+            _address = (_interface,int(_control.get("control-port",8953)))
+        else: ## tls only with unbound-control
+            return self._run_prog(["/usr/local/sbin/unbound-control", "-c", config, command])
+        _sock.settimeout(10)
+        try:
+            _sock.connect(_address)
+            _sock.sendall(f"UBCT1 {command}\n".encode("utf-8"))
+            _data = []
+            while True:
+                _sockdata = _sock.recv(65536)
+                if not _sockdata:
+                    break
+                _data.append(_sockdata)
+            return b"".join(_data).decode("utf-8")
+        finally:
+            _sock.close()
+
+    def _get_unbound_stats(self):
+        _now = time.time()
+        if _now - self._unbound_stats[0] > 10: ## shared by check_unbound and checklocal_unbound within one poll
+            _output = self._read_unbound_socket("stats_noreset")
+            _stats = {}
+            for _line in _output.splitlines():
+                _key, _sep, _val = _line.partition("=")
+                if _sep:
+                    _stats[_key] = _val.strip()
+            if not _stats:
+                raise ValueError("no unbound statistics")
+            self._unbound_stats = (_now,_stats)
+        return self._unbound_stats[1]
+
+    def check_unbound(self):
+        if not os.path.exists(self._path("/var/unbound/unbound.conf")):
+            return []
+        try:
+            _stats = self._get_unbound_stats()
+        except:
+            return []
+        _ret = ["<<<unbound:sep(61)>>>"]
+        for _key,_val in _stats.items():
+            _ret.append(f"{_key}={_val}")
+        return _ret
+
+    @staticmethod
+    def _histogram_percentile(histogram,percentile):
+        _total = sum(map(lambda x: x[1],histogram))
+        if _total <= 0:
+            return 0
+        _count = 0
+        for _upper,_value in histogram:
+            _count += _value
+            if _count >= _total * percentile:
+                return _upper
+        return histogram[-1][0]
+
     def checklocal_unbound(self):
         _ret = []
         try:
-            _output = self._run_prog(["/usr/local/sbin/unbound-control", "-c", "/var/unbound/unbound.conf", "stats_noreset"])
+            _stats = dict(map(lambda x: (x[0],float(x[1])),self._get_unbound_stats().items()))
             _unbound_stat = dict(
                 map(
-                    lambda x: (x[0].replace(".","_"),float(x[1])),
-                        re.findall("total\.([\w.]+)=([\d.]+)",_output)
+                    lambda x: (x[0][6:].replace(".","_"),x[1]),
+                    filter(lambda x: x[0].startswith("total."),_stats.items())
+                )
+            )
+            _counters = dict(filter(lambda x: x[0].startswith("total.num.") or x[0].startswith("histogram."),_stats.items()))
+            _interval, _delta = self._get_counter_deltas("unbound","counters",_counters)
+            _queries = _delta.get("total.num.queries",0)
+            _cachehits = _delta.get("total.num.cachehits",0)
+            _unbound_stat["queries_per_sec"] = _queries / _interval if _delta else 0
+            _unbound_stat["cache_hit_ratio"] = _cachehits * 100 / _queries if _queries else 0
+            _histogram = sorted(
+                map(
+                    lambda x: (float(x[0].split(".to.")[1]),x[1]),
+                    filter(lambda x: x[0].startswith("histogram."),_delta.items())
                 )
             )
-            _ret.append("0 \"Unbound DNS\" dns_successes={num_queries:.0f}|dns_recursion={num_recursivereplies:.0f}|dns_cachehits={num_cachehits:.0f}|dns_cachemiss={num_cachemiss:.0f}|avg_response_time={recursion_time_avg} Unbound running".format(**_unbound_stat))
+            _unbound_stat["response_time_median"] = self._histogram_percentile(_histogram,0.5)
+            _unbound_stat["response_time_p95"] = self._histogram_percentile(_histogram,0.95)
+            _ret.append("0 \"Unbound DNS\" dns_successes={num_queries:.0f}|dns_recursion={num_recursivereplies:.0f}|dns_cachehits={num_cachehits:.0f}|dns_cachemiss={num_cachemiss:.0f}|avg_response_time={recursion_time_avg}|queries_per_sec={queries_per_sec:.2f}|cache_hit_ratio={cache_hit_ratio:.2f}|response_time_median={response_time_median}|response_time_p95={response_time_p95} Unbound running".format(**_unbound_stat))
         except:
             _ret.append("2 \"Unbound DNS\" dns_successes=0|dns_recursion=0|dns_cachehits=0|dns_cachemiss=0|avg_response_time=0 Unbound not running")
         return _ret
@@ -974,7 +1959,7 @@ class checkmk_checker(object):
                 _acmecerts = [_acmecerts]
         except:
             _acmecerts = []
-        for _cert_info in _acmecerts:
+        for _cert_info in map(dict,_acmecerts):
             if _cert_info.get("enabled") != "1":
                 continue
             if not _cert_info.get("description"):
@@ -1005,8 +1990,9 @@ class checkmk_checker(object):
         return _ret
 
     def _read_nginx_socket(self):
+        import requests
         session = requests.Session()
-        session.mount("http://nginx/", NginxAdapter())
+        session.mount("http://nginx/", nginx_adapter())
         response = session.get("http://nginx/vts")
         return response.json()
 
@@ -1019,6 +2005,7 @@ class checkmk_checker(object):
         if type(_upstream_config) != list:
             _upstream_config = [_upstream_config]
 
+        import requests
         try:        
             _data = self._read_nginx_socket()
         except (requests.exceptions.ConnectionError,FileNotFoundError):
@@ -1076,7 +2063,6 @@ class checkmk_checker(object):
     def check_smartinfo(self):
         if not os.path.exists("/usr/local/sbin/smartctl"):
             return []
-        REGEX_DISCPATH = re.compile("(sd[a-z]+|da[0-9]+|nvme[0-9]+|ada[0-9]+)$")
         _ret = ["<<<disk_smart_info:sep(124)>>>"]
         for _dev in filter(lambda x: REGEX_DISCPATH.match(x),os.listdir("/dev/")):
             try:
@@ -1090,7 +2076,7 @@ class checkmk_checker(object):
             return []
         _ret = ["<<<ipmi:sep(124)>>>"]
         _out = self._run_prog("/usr/local/bin/ipmitool sensor list")
-        _ret += re.findall("^(?!.*\sna\s.*$).*",_out,re.M)
+        _ret += REGEX_IPMI_AVAILABLE.findall(_out)
         return _ret
 
     def check_df(self):
@@ -1109,6 +2095,12 @@ class checkmk_checker(object):
         _ret.append("processes {0}".format(_sum))
         return _ret
 
+    def _get_temperature_sensors(self):
+        if self._available_sysctl_temperature_list == None: ## discovered once on first use
+            _oids = " ".join(self._run_progs("sysctl -N hw.acpi.thermal","sysctl -N dev",timeout=10,ignore_error=True)).split()
+            self._available_sysctl_temperature_list = list(filter(lambda x: x.lower().find("temperature") > -1 and x.lower().find("cpu") == -1,_oids))
+        return self._available_sysctl_temperature_list
+
     def check_temperature(self):
         _ret = ["<<<lnx_thermal:sep(124)>>>"]
         _out = self._run_prog("sysctl dev.cpu",timeout=10)
@@ -1125,7 +2117,7 @@ class checkmk_checker(object):
             _ret.append(f"CPU|enabled|unknown|{_cpu_temperature}")
         
         _count = 0
-        for _tempsensor in self._available_sysctl_temperature_list:
+        for _tempsensor in self._get_temperature_sensors():
             _out = self._run_prog(f"sysctl -n {_tempsensor}",timeout=10)
             if _out:
                 try:
@@ -1144,7 +2136,7 @@ class checkmk_checker(object):
 
     def check_mem(self):
         _ret = ["<<<statgrab_mem>>>"]
-        _pagesize = int(self._run_prog("sysctl -n hw.pagesize"))
+        _pagesize = self._get_host_facts().get("pagesize")
         _out = self._run_prog("sysctl vm.stats",timeout=10)
         _mem = dict(map(lambda x: (x[0],int(x[1])) ,[_v.split(": ") for _v in _out.split("\n") if len(_v.split(": ")) == 2]))
         _mem_cache = _mem.get("vm.stats.vm.v_cache_count") * _pagesize
@@ -1173,15 +2165,61 @@ class checkmk_checker(object):
             return []
         return _ret
 
+    def _get_arcstats(self):
+        _ret = {}
+        for _name in ZFS_ARCSTATS:
+            try:
+                _ret[_name] = struct.unpack("Q",sysctlbyname(f"kstat.zfs.misc.arcstats.{_name}")[:8])[0]
+            except (OSError,struct.error): ## not on every zfs version
+                pass
+        return _ret
+
     def check_zfs(self):
+        ## zfs get is slow and takes pool locks, it is refreshed in the background
+        _zfsget = self._run_cache_prog("zfs get -t filesystem,volume -Hp name,quota,used,avail,mountpoint,type",cachetime=ZFS_CACHETIME,stale=True)
+        _df = self._run_prog("df -kP -t zfs")
         _ret = ["<<<zfsget>>>"]
-        _ret.append(self._run_prog("zfs get -t filesystem,volume -Hp name,quota,used,avail,mountpoint,type"))
+        _ret.append(_zfsget)
         _ret.append("[df]")
-        _ret.append(self._run_prog("df -kP -t zfs"))
+        _ret.append(_df)
         _ret.append("<<<zfs_arc_cache>>>")
-        _ret.append(self._run_prog("sysctl -q kstat.zfs.misc.arcstats").replace("kstat.zfs.misc.arcstats.","").replace(": "," = ").strip())
+        _arcstats = self._get_arcstats()
+        if _arcstats:
+            for _name,_value in _arcstats.items():
+                _ret.append(f"{_name} = {_value}")
+        else:
+            _arcstats = self._run_prog("sysctl -q kstat.zfs.misc.arcstats")
+            _ret.append(_arcstats.replace("kstat.zfs.misc.arcstats.","").replace(": "," = ").strip())
         return _ret
 
+    def checklocal_zfsarc(self):
+        _arcstats = self._get_arcstats()
+        if "hits" not in _arcstats:
+            return []
+        _counters = dict(filter(lambda x: x[0].endswith("hits") or x[0].endswith("misses"),_arcstats.items()))
+        _interval, _delta = self._get_counter_deltas("zfs","arcstats",_counters)
+        if not _delta:
+            _delta = dict.fromkeys(_counters,0)
+            _interval = 1
+        _last_size = self._get_storedata("zfs","arcsize") ## the arc shrinks, not a counter
+        self._set_storedata("zfs","arcsize",_arcstats.get("size",0))
+        _delta["size"] = _arcstats.get("size",0) - _last_size if _last_size != None else 0
+        _ratio = lambda hits,misses: 100.0 * _delta.get(hits,0) / max(1,_delta.get(hits,0) + _delta.get(misses,0))
+        _perfdata = [
+            "arc_hit_ratio={0:.2f}".format(_ratio("hits","misses")),
+            "arc_demand_data_hit_ratio={0:.2f}".format(_ratio("demand_data_hits","demand_data_misses")),
+            "arc_demand_metadata_hit_ratio={0:.2f}".format(_ratio("demand_metadata_hits","demand_metadata_misses")),
+            "arc_hits={0:.2f}".format(_delta.get("hits",0) / _interval),
+            "arc_misses={0:.2f}".format(_delta.get("misses",0) / _interval),
+            "arc_size={0};;;{1};{2}".format(_arcstats.get("size",0),_arcstats.get("c_min",0),_arcstats.get("c_max",0)),
+            "arc_size_delta={0}".format(_delta.get("size",0)),
+            "arc_target_size={0}".format(_arcstats.get("c",0))
+        ]
+        if "l2_hits" in _arcstats and _arcstats.get("l2_size"):
+            _perfdata.append("l2arc_hit_ratio={0:.2f}".format(_ratio("l2_hits","l2_misses")))
+        return ["0 \"ZFS ARC\" {0} {1:.1f}% hit ratio, size {2} MiB of {3} MiB".format(
+            "|".join(_perfdata),_ratio("hits","misses"),_arcstats.get("size",0) >> 20,_arcstats.get("c_max",0) >> 20)]
+
     def check_mounts(self):
         _ret = ["<<<mounts>>>"]
         _ret.append(self._run_prog("mount -p -t ufs").strip())
@@ -1189,81 +2227,173 @@ class checkmk_checker(object):
 
     def check_cpu(self):
         _ret = ["<<<cpu>>>"]
-        _loadavg = self._run_prog("sysctl -n vm.loadavg").strip("{} \n")
-        _proc = self._run_prog("top -b -n 1").split("\n")[1].split(" ")
+        _loadavg, _proc, _lastpid = self._run_progs("sysctl -n vm.loadavg","top -b -n 1","sysctl -n kern.lastpid")
+        _loadavg = _loadavg.strip("{} \n")
+        _proc = _proc.split("\n")[1].split(" ")
         _proc = "{0}/{1}".format(_proc[3],_proc[0])
-        _lastpid = self._run_prog("sysctl -n kern.lastpid").strip(" \n")
-        _ncpu = self._run_prog("sysctl -n hw.ncpu").strip(" \n")
+        _lastpid = _lastpid.strip(" \n")
+        _ncpu = self._get_host_facts().get("ncpu")
         _ret.append(f"{_loadavg} {_proc} {_lastpid} {_ncpu}")
         return _ret
 
     def check_netctr(self):
         _ret = ["<<<netctr>>>"]
-        _out = self._run_prog("netstat -inb")
-        for _line in re.finditer("^(?!Name|lo|plip)(?P<iface>\w+)\s+(?P<mtu>\d+).*?Link.*?\s+.*?\s+(?P<inpkts>\d+)\s+(?P<inerr>\d+)\s+(?P<indrop>\d+)\s+(?P<inbytes>\d+)\s+(?P<outpkts>\d+)\s+(?P<outerr>\d+)\s+(?P<outbytes>\d+)\s+(?P<coll>\d+)$",_out,re.M):
-            _ret.append("{iface} {inbytes} {inpkts} {inerr} {indrop} 0 0 0 0 {outbytes} {outpkts} {outerr} 0 0 0 0 0".format(**_line.groupdict()))
+        for _line in self._run_prog("netstat -inb").split("\n"):
+            ## Name Mtu Network Address Ipkts Ierrs Idrop Ibytes Opkts Oerrs Obytes Coll
+            _fields = _line.split()
+            if len(_fields) < 11 or _fields[0].startswith(("Name","lo","plip")) or "Link" not in _fields[2]:
+                continue
+            _iface = _fields[0]
+            _inpkts, _inerr, _indrop, _inbytes, _outpkts, _outerr, _outbytes, _coll = _fields[-8:]
+            if not _iface.replace("_","").isalnum() or not _fields[1].isdigit() or not "".join(_fields[-8:]).isdigit():
+                continue
+            _ret.append(f"{_iface} {_inbytes} {_inpkts} {_inerr} {_indrop} 0 0 0 0 {_outbytes} {_outpkts} {_outerr} 0 0 0 0 0")
         return _ret
 
+    @staticmethod
+    def _ntp_interval(seconds):
+        ## ntpq prettyinterval
+        if seconds <= 0:
+            return "-"
+        if seconds <= 2048:
+            return str(seconds)
+        seconds = (seconds + 29) // 60
+        if seconds <= 300:
+            return f"{seconds}m"
+        seconds = (seconds + 29) // 60
+        if seconds <= 96:
+            return f"{seconds}h"
+        return f"{(seconds + 11) // 24}d"
+
+    def _ntp_peerline(self,status,peer,now):
+        _stratum = int(peer.get("stratum") or 16)
+        _refid = peer.get("refid","")
+        try:
+            ipaddress.ip_address(_refid)
+        except ValueError: ## reference clock ids and kiss codes in dots like ntpq, also for a local clock at stratum 10
+            _refid = f".{_refid}."
+        _hmode = int(peer.get("hmode") or 0)
+        _type = {1: "s", 2: "s", 3: "u", 5: "B"}.get(_hmode,"-")
+        if peer.get("srcadr","").startswith("127.127."):
+            _type = "l"
+        elif _hmode == 3 and peer.get("refid") == "POOL":
+            _type = "p"
+        _last = 0
+        for _var in ("rec","reftime"):
+            _timestamp = int(peer.get(_var,"0x0").split(".")[0],16)
+            if _timestamp:
+                _last = _timestamp - 2208988800 ## ntp era 0
+                break
+        _when = self._ntp_interval(int(now - _last)) if _last else "-"
+        _poll = 1 << min(int(peer.get("ppoll") or 0),int(peer.get("hpoll") or 0))
+        _reach = int(peer.get("reach") or "0",0)
+        return "{0} {1:<15} {2:<15} {3:>2} {4} {5:>4} {6:>4} {7:>4o} {8:>8.3f} {9:>8.3f} {10:>8.3f}".format(
+            ntp_control.TALLY[(status >> 8) & 0x7],
+            peer.get("srcadr",""),_refid,_stratum,_type,_when,_poll,_reach,
+            float(peer.get("delay") or 0),float(peer.get("offset") or 0),float(peer.get("jitter") or 0)
+        )
+
     def check_ntp(self):
         _ret = ["<<<ntp>>>"]
-        for _line in self._run_prog("ntpq -np",timeout=30).split("\n")[2:]:
-            if _line.strip():
-                _ret.append("{0} {1}".format(_line[0],_line[1:]))
+        if self._provider and not self._provider.record: ## peer lines recorded like a command output
+            return _ret + self._provider.run(["ntp_control","peers"]).splitlines()
+        try:
+            with ntp_control() as _ntp:
+                for _associd, _status in _ntp.peers():
+                    _ret.append(self._ntp_peerline(_status,_ntp.peervars(_associd),time.time()))
+        except (OSError,ValueError,struct.error): ## ntpd not running or not answering within the deadline
+            pass
+        if self._provider:
+            self._provider.save(["ntp_control","peers"],"\n".join(_ret[1:]))
         return _ret
         
 
     def check_tcp(self):
         _ret = ["<<<tcp_conn_stats>>>"]
+        try:
+            ## kernel counters per tcp state (uint64_t[TCP_NSTATES]), same source as netstat -s -p tcp
+            _states = sysctlbyname("net.inet.tcp.states")
+            for _state,_count in zip(TCP_STATES,struct.unpack("{0}Q".format(len(_states) // 8),_states[:len(_states) // 8 * 8])):
+                if _count and _state != "CLOSED":
+                    _ret.append(f"{_state} {_count}")
+            return _ret
+        except OSError:
+            pass
         _out = self._run_prog("netstat -na")
-        counts = Counter(re.findall("ESTABLISHED|LISTEN",_out))
+        counts = Counter(REGEX_TCP_STATE.findall(_out))
         for _key,_val in counts.items():
             _ret.append(f"{_key} {_val}")
         return _ret
 
     def check_ps(self):
         _ret = ["<<<ps>>>"]
-        _out = self._run_prog("ps ax -o state,user,vsz,rss,pcpu,command")
-        for _line in re.finditer("^(?P<stat>\w+)\s+(?P<user>\w+)\s+(?P<vsz>\d+)\s+(?P<rss>\d+)\s+(?P<cpu>[\d.]+)\s+(?P<command>.*)$",_out,re.M):
-            _ret.append("({user},{vsz},{rss},{cpu}) {command}".format(**_line.groupdict()))
+        for _line in self._run_prog("ps ax -o state,user,vsz,rss,pcpu,command").split("\n"):
+            _fields = _line.split(None,5)
+            if len(_fields) < 6 or not _fields[2].isdigit() or not _fields[3].isdigit():
+                continue
+            _stat, _user, _vsz, _rss, _cpu, _command = _fields
+            if not _stat.replace("_","").isalnum() or not _user.replace("_","").isalnum() or _cpu.strip("0123456789."):
+                continue ## same rows as the former regex, states like Ss+ or I< and users like www-data are skipped
+            _ret.append(f"({_user},{_vsz},{_rss},{_cpu}) {_command}")
         return _ret
         
 
     def check_uptime(self):
         _ret = ["<<<uptime>>>"]
         _uptime_sec = time.time() - int(self._run_prog("sysctl -n kern.boottime").split(" ")[3].strip(" ,"))
-        _idle_sec = re.findall("(\d+):[\d.]+\s+\[idle\]",self._run_prog("ps axw"))[0]
+        _idle_sec = REGEX_PS_IDLE.findall(self._run_prog("ps axw"))[0]
         _ret.append(f"{_uptime_sec} {_idle_sec}")
         return _ret
 
     def _run_prog(self,cmdline="",*args,shell=False,timeout=60,ignore_error=False):
-        if type(cmdline) == str:
-            _process = shlex.split(cmdline,posix=True)
-        else:
-            _process = cmdline
-        try:
-            return subprocess.check_output(_process,encoding="utf-8",shell=shell,stderr=subprocess.DEVNULL,timeout=timeout)
-        except subprocess.CalledProcessError as e:
-            if ignore_error:
-                return e.stdout
-            return ""
-        except subprocess.TimeoutExpired:
-            return ""
+        return self._run_progs(cmdline,shell=shell,timeout=timeout,ignore_error=ignore_error)[0]
+
+    def _run_progs(self,*cmdlines,shell=False,timeout=60,ignore_error=False):
+        _processes = [shlex.split(_cmdline,posix=True) if type(_cmdline) == str else _cmdline for _cmdline in cmdlines]
+        self._perf_local.processes = getattr(self._perf_local,"processes",0) + len(_processes)
+        if self._provider and not self._provider.record:
+            return list(map(self._provider.run,_processes))
+        _ret = []
+        for _result in self._process_runner.run_many(_processes,shell=shell,timeout=timeout):
+            if isinstance(_result,subprocess.CalledProcessError):
+                _ret.append(_result.stdout if ignore_error else "")
+            elif isinstance(_result,subprocess.TimeoutExpired):
+                _ret.append("")
+            elif isinstance(_result,BaseException):
+                raise _result
+            else:
+                _ret.append(_result)
+        if self._provider:
+            for _process,_output in zip(_processes,_ret):
+                self._provider.save(_process,_output)
+        return _ret
 
-    def _run_cache_prog(self,cmdline="",cachetime=10,*args,shell=False,ignore_error=False):
+    def _run_cache_prog(self,cmdline="",cachetime=10,*args,shell=False,ignore_error=False,stale=False):
         if type(cmdline) == str:
             _process = shlex.split(cmdline,posix=True)
         else:
             _process = cmdline
-        _process_id = "".join(_process)
+        if self._provider and not self._provider.record:
+            return self._provider.run(_process)
+        return self._get_cache_runner(_process,shell=shell,ignore_error=ignore_error).get(cachetime,stale=stale)
+
+    def _path(self,path):
+        if self._provider:
+            return self._provider.path(path)
+        return path
+
+    def _get_cache_runner(self,process,shell=False,ignore_error=False):
+        _process_id = "".join(process)
         _runner = self._check_cache.get(_process_id)
         if _runner == None:
-            _runner = checkmk_cached_process(_process,shell=shell,ignore_error=ignore_error)
+            _runner = checkmk_cached_process(process,shell=shell,ignore_error=ignore_error,runner=self._process_runner)
             self._check_cache[_process_id] = _runner
-        return _runner.get(cachetime)
+        return _runner
 
 class checkmk_cached_process(object):
-    def __init__(self,process,shell=False,ignore_error=False):
+    def __init__(self,process,shell=False,ignore_error=False,runner=None):
         self._processs = process
+        self._process_runner = runner if runner else checkmk_checker._process_runner
         self._islocal = os.path.dirname(process[0]).startswith(LOCALDIR)
         self._shell = shell
         self._ignore_error = ignore_error
@@ -1271,10 +2401,13 @@ class checkmk_cached_process(object):
         with self._mutex:
             self._data = (0,"")
             self._thread = None
+            self.duration = 0 ## wall time of the last finished run
+            self.runs = 0
 
     def _runner(self,timeout):
+        _start = time.perf_counter()
         try:
-            _data = subprocess.check_output(self._processs,shell=self._shell,encoding="utf-8",stderr=subprocess.DEVNULL,timeout=timeout)
+            _data = self._process_runner.run(self._processs,shell=self._shell,timeout=timeout,pool="cached")
         except subprocess.CalledProcessError as e:
             if self._ignore_error:
                 _data = e.stdout
@@ -1285,22 +2418,37 @@ class checkmk_cached_process(object):
         with self._mutex:
             self._data = (int(time.time()),_data)
             self._thread = None
+            self.duration = time.perf_counter() - _start
+            self.runs += 1
 
-    def get(self,cachetime):
+    def start(self,cachetime):
         with self._mutex:
             _now = time.time()
             _mtime = self._data[0]
-        if _now - _mtime > cachetime or cachetime == 0:
-            if not self._thread:
+            if (_now - _mtime > cachetime or cachetime == 0) and not self._thread:
                 if cachetime > 0:
                     _timeout = cachetime*2-1
                 else:
                     _timeout = None
-                with self._mutex:
-                    self._thread = threading.Thread(target=self._runner,args=[_timeout])
+                self._thread = threading.Thread(target=self._runner,args=[_timeout])
                 self._thread.start()
+            return self._thread
+
+    def get(self,cachetime,timeout=30,stale=False):
+        _thread = self.start(cachetime)
+        if _thread and not (stale and self._data[0]): ## stale returns the last output while refreshing
+            _thread.join(timeout) ## waitmax
+        return self._format(cachetime)
 
-            self._thread.join(30) ## waitmax
+    def collect(self,cachetime,timeout=30):
+        ## waits for the run from start() and never starts another one
+        with self._mutex:
+            _thread = self._thread
+        if _thread:
+            _thread.join(timeout)
+        return self._format(cachetime)
+
+    def _format(self,cachetime):
         with self._mutex:
             _mtime, _data = self._data
         if not _data.strip():
@@ -1308,17 +2456,37 @@ class checkmk_cached_process(object):
         if self._islocal:
             _data = "".join([f"cached({_mtime},{cachetime}) {_line}" for _line in _data.splitlines(True) if len(_line.strip()) > 0])
         else:
-            _data = re.sub("\B[<]{3}(.*?)[>]{3}\B",f"<<<\\1:cached({_mtime},{cachetime})>>>",_data)
+            _data = REGEX_SECTION_HEADER.sub(f"<<<\\1:cached({_mtime},{cachetime})>>>",_data)
         return _data
 
 class checkmk_server(TCPServer,checkmk_checker):
-    def __init__(self,port,pidfile,user,onlyfrom=None,encryptionkey=None,skipcheck=None,**kwargs):
+    def __init__(self,port,pidfile,user,onlyfrom=None,encryptionkey=None,compress=None,delta=False,perfsection=False,memorylimit=None,skipcheck=None,replay=None,record=None,realtime=None,realtime_port=6559,realtime_timeout=90,realtime_encrypt=None,ratelimit=None,maxconnections=None,**kwargs):
         self.pidfile = pidfile
         self.onlyfrom = onlyfrom.split(",") if onlyfrom else None
+        self._allowlist = ip_allowlist(self.onlyfrom) if onlyfrom else None
+        self.ratelimit = ratelimit
+        self._buckets = bounded_store(maxsize=CACHE_MAXSIZE,ttl=3600)
+        self._last_payload = (0,b"")
+        if maxconnections:
+            self.request_queue_size = maxconnections ## connections are served one by one, the rest wait in the listen queue
         self.skipcheck = skipcheck.split(",") if skipcheck else []
-        self._available_sysctl_list = self._run_prog("sysctl -aN").split()
-        self._available_sysctl_temperature_list = list(filter(lambda x: x.lower().find("temperature") > -1 and x.lower().find("cpu") == -1,self._available_sysctl_list))
+        if replay or record:
+            self._provider = checkmk_replay(replay or record,record=bool(record))
         self.encryptionkey = encryptionkey
+        self.compress = compress
+        self.delta = delta
+        self.perfsection = perfsection
+        self.memorylimit = memorylimit
+        self._rss = 0
+        self._restart_argv = [sys.executable,os.path.abspath(sys.argv[0])] + list(filter(lambda x: x not in ("--start","--stop","--status","--debug","--nodaemon"),sys.argv[1:])) + ["--nodaemon"]
+        self.realtime = realtime.split(",") if realtime else []
+        self.realtime_port = realtime_port
+        self.realtime_timeout = realtime_timeout
+        self.realtime_encrypt = realtime_encrypt
+        self._realtime_key = None
+        self._realtime_remote = (None,0)
+        self._realtime_thread = None
+        self._realtime_mutex = threading.Lock()
         self._mutex = threading.Lock()
         self.user = pwd.getpwnam(user)
         self.allow_reuse_address = True
@@ -1330,17 +2498,109 @@ class checkmk_server(TCPServer,checkmk_checker):
             os.setgid(_gid)
             os.setuid(_uid)
 
+    def shutdown_request(self,request):
+        super().shutdown_request(request)
+        ## response is sent, restart if the last poll measured too much memory
+        if self.memorylimit and self._rss > self.memorylimit * 1024:
+            log(f"checkmk_agent rss {self._rss} KiB above limit, restarting","warning")
+            self.server_close()
+            os.execv(self._restart_argv[0],self._restart_argv)
+
     def verify_request(self, request, client_address):
-        if self.onlyfrom and client_address[0] not in self.onlyfrom:
+        if self.onlyfrom and client_address[0] not in self._allowlist:
             return False
         return True
 
+    def admit_request(self,remote_ip):
+        ## token bucket per source, ratelimit polls per minute with a burst of RATELIMIT_BURST
+        if not self.ratelimit:
+            return True
+        _now = time.monotonic()
+        _tokens, _last = self._buckets.get(remote_ip,(RATELIMIT_BURST,_now))
+        _tokens = min(RATELIMIT_BURST,_tokens + (_now - _last) * self.ratelimit / 60)
+        if _tokens < 1:
+            self._buckets[remote_ip] = (_tokens,_now)
+            return False
+        self._buckets[remote_ip] = (_tokens - 1,_now)
+        return True
+
+    def throttled_payload(self):
+        _timestamp, _payload = self._last_payload
+        if time.monotonic() - _timestamp < THROTTLE_MAXAGE:
+            return _payload
+        return b""
+
+    def realtime_trigger(self,remote_ip):
+        ## every regular poll keeps the realtime checks alive for realtime_timeout seconds
+        if not self.realtime or not remote_ip:
+            return
+        with self._realtime_mutex:
+            self._realtime_remote = (remote_ip,time.time())
+            if self._realtime_thread:
+                return
+            self._realtime_thread = threading.Thread(target=self._realtime_loop,name="realtime",daemon=True)
+            self._realtime_thread.start()
+
+    def _realtime_section(self,name):
+        if name == "net":
+            return self._realtime_net()
+        if hasattr(self,f"check_{name}"):
+            return getattr(self,f"check_{name}")()
+        if hasattr(self,f"checklocal_{name}"):
+            return ["<<<local:sep(0)>>>"] + getattr(self,f"checklocal_{name}")()
+        return []
+
+    def _realtime_encrypt_message(self,message):
+        from cryptography.hazmat.backends import default_backend as crypto_default_backend
+        from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+        if not self._realtime_key: ## openssl enc -aes-256-cbc -md md5 -nosalt
+            _password = self.realtime_encrypt.encode("utf-8")
+            _keydata = _block = b""
+            while len(_keydata) < 48:
+                _block = hashlib.md5(_block + _password).digest()
+                _keydata += _block
+            self._realtime_key = (_keydata[:32],_keydata[32:48])
+        _key, _iv = self._realtime_key
+        _encryptor = Cipher(
+            algorithms.AES(_key),
+            modes.CBC(_iv),
+            backend = crypto_default_backend()
+        ).encryptor()
+        return _encryptor.update(pad_pkcs7(message)) + _encryptor.finalize()
+
+    def _realtime_loop(self):
+        while True:
+            _start = time.monotonic()
+            with self._realtime_mutex:
+                _remote_ip, _triggered = self._realtime_remote
+                if time.time() - _triggered > self.realtime_timeout:
+                    self._realtime_thread = None
+                    return
+            with socket.socket(socket.AF_INET6 if ":" in _remote_ip else socket.AF_INET,socket.SOCK_DGRAM) as _sock:
+                for _section in self.realtime:
+                    try:
+                        _lines = self._realtime_section(_section)
+                        if not _lines:
+                            continue
+                        ## protocol, plaintext timestamp, section (encrypted with protocol 00)
+                        _timestamp = str(int(time.time())).encode("utf-8")
+                        _message = "{0}\n".format("\n".join(_lines)).encode("utf-8")
+                        if self.realtime_encrypt:
+                            _message = b"00" + _timestamp + self._realtime_encrypt_message(_message)
+                        else:
+                            _message = b"99" + _timestamp + _message
+                        _sock.sendto(_message,(_remote_ip,self.realtime_port))
+                    except:
+                        pass
+            time.sleep(max(0,1 - (time.monotonic() - _start)))
+
     def server_start(self):
         log("starting checkmk_agent\n")
         signal.signal(signal.SIGTERM, self._signal_handler)
         signal.signal(signal.SIGINT, self._signal_handler)
         signal.signal(signal.SIGHUP, self._signal_handler)
         self._change_user()
+        self._get_host_facts()
         try:
             self.server_bind()
             self.server_activate()
@@ -1531,29 +2791,79 @@ if __name__ == "__main__":
         help=_(""))
     _parser.add_argument("--encrypt",type=str,dest="encryptionkey",
         help=_("Encryption password (do not use from cmdline)"))
+    _parser.add_argument("--compress",type=str,choices=["zlib"],
+        help=_("compress output with zlib (before encryption), the receiving side has to inflate it"))
+    _parser.add_argument("--delta",action="store_true",
+        help=_("send unchanged sections with a cached header since their last change"))
+    _parser.add_argument("--memorylimit",type=int,metavar="MiB",
+        help=_("report memory usage and restart the daemon above MiB rss"))
+    _parser.add_argument("--perfsection",action="store_true",
+        help=_("add per section timing as checkmk_agent_perf section"))
+    _parser.add_argument("--profile",type=int,metavar="N",
+        help=_("run N checks under cProfile and show the slowest functions"))
+    _parser.add_argument("--replay",type=str,metavar="DIR",
+        help=_("replay recorded command output and files from DIR (with --debug/--profile)"))
+    _parser.add_argument("--record",type=str,metavar="DIR",
+        help=_("record command output and files to DIR (with --debug)"))
+    _parser.add_argument("--realtime",type=str,
+        help=_("comma seperated checks sent as realtime checks via udp"))
+    _parser.add_argument("--realtime-port",type=int,default=6559,
+        help=_("udp port of the checkmk realtime receiver"))
+    _parser.add_argument("--realtime-timeout",type=int,default=90,
+        help=_("seconds realtime checks are sent after the last poll"))
+    _parser.add_argument("--realtime-encrypt",type=str,
+        help=_("Realtime encryption secret (do not use from cmdline)"))
     _parser.add_argument("--pidfile",type=str,default="/var/run/checkmk_agent.pid",
         help=_(""))
     _parser.add_argument("--onlyfrom",type=str,
-        help=_("comma seperated ip addresses to allow"))
+        help=_("comma seperated ip addresses or networks (cidr) to allow"))
+    _parser.add_argument("--ratelimit",type=int,
+        help=_("polls per minute per source ip, throttled polls get the last output"))
+    _parser.add_argument("--maxconnections",type=int,
+        help=_("maximum number of waiting connections"))
     _parser.add_argument("--skipcheck",type=str,
         help=_("R|comma seperated checks that will be skipped \n{0}".format("\n".join([", ".join(_checks_available[i:i+10]) for i in range(0,len(_checks_available),10)]))))
     _parser.add_argument("--debug",action="store_true",
         help=_("debug Ausgabe"))
     args = _parser.parse_args()
     if args.configfile and os.path.exists(args.configfile):
-        for _k,_v in re.findall(f"^(\w+):\s*(.*?)(?:\s+#|$)",open(args.configfile,"rt").read(),re.M):
+        for _k,_v in REGEX_CONFIGFILE.findall(open(args.configfile,"rt").read()):
             if _k == "port":
                 args.port = int(_v)
             if _k == "encrypt":
                 args.encryptionkey = _v
+            if _k == "compress":
+                args.compress = _v
+            if _k == "memorylimit":
+                args.memorylimit = int(_v)
+            if _k == "perfsection":
+                args.perfsection = _v.lower() in ("1","yes","true","on")
+            if _k == "delta":
+                args.delta = _v.lower() in ("1","yes","true","on")
+            if _k == "realtime":
+                args.realtime = _v
+            if _k == "realtime_port":
+                args.realtime_port = int(_v)
+            if _k == "realtime_timeout":
+                args.realtime_timeout = int(_v)
+            if _k == "realtime_encrypt":
+                args.realtime_encrypt = _v
             if _k == "onlyfrom":
                 args.onlyfrom = _v
+            if _k == "ratelimit":
+                args.ratelimit = int(_v)
+            if _k == "maxconnections":
+                args.maxconnections = int(_v)
             if _k == "skipcheck":
                 args.skipcheck = _v
             if _k.lower() == "localdir":
                 LOCALDIR = _v
             if _k.lower() == "spooldir":
                 SPOOLDIR = _v
+            if _k.lower() == "localtimebudget":
+                LOCAL_TIMEBUDGET = int(_v)
+            if _k.lower() == "zfscachetime":
+                ZFS_CACHETIME = int(_v)
 
     _server = checkmk_server(**args.__dict__)
     _pid = None
@@ -1561,11 +2871,12 @@ if __name__ == "__main__":
         with open(args.pidfile,"rt") as _pidfile:
             _pid = int(_pidfile.read())
     except (FileNotFoundError,IOError):
-        _out = subprocess.check_output(["sockstat", "-l", "-p", str(args.port),"-P", "tcp"],encoding=sys.stdout.encoding)
-        try:
-            _pid = int(re.findall("\s(\d+)\s",_out.split("\n")[1])[0])
-        except (IndexError,ValueError):
-            pass
+        if not args.replay and shutil.which("sockstat"): ## replays run off the firewall
+            _out = subprocess.check_output(["sockstat", "-l", "-p", str(args.port),"-P", "tcp"],encoding=sys.stdout.encoding)
+            try:
+                _pid = int(REGEX_SOCKSTAT_PID.findall(_out.split("\n")[1])[0])
+            except (IndexError,ValueError):
+                pass
     if args.start:
         if _pid:
             try:
@@ -1588,6 +2899,23 @@ if __name__ == "__main__":
             sys.exit(1)
         os.kill(int(_pid),signal.SIGTERM)
 
+    elif args.profile:
+        import cProfile
+        import pstats
+        import tracemalloc
+        sys.stdout.write("startup: {0:.1f} ms cpu, baseline rss: {1} KiB\n".format(time.process_time() * 1000,resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+        tracemalloc.start()
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+        for _ in range(args.profile):
+            _server.do_checks()
+        _profiler.disable()
+        _, _peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        pstats.Stats(_profiler,stream=sys.stdout).sort_stats("cumulative").print_stats(30)
+        sys.stdout.write(f"peak memory: {_peak_memory / 1024:.0f} KiB\n")
+        sys.stdout.write("\n".join(_server._perf_lines()) + "\n")
+        sys.stdout.flush()
     elif args.debug:
         sys.stdout.write(_server.do_checks(debug=True).decode(sys.stdout.encoding))
         sys.stdout.flush()
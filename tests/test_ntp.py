@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=utf-8:noet
+
+## ntp_control against a mode 6 udp stub and the peer lines against ntpq -np
+## python3 -m unittest discover tests
+
+import os
+import sys
+import time
+import socket
+import struct
+import threading
+import unittest
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),".."))
+import opnsense_checkmk_agent as agent
+
+NTP_EPOCH = 2208988800
+NOW = 1760000000
+
+## ntpq -np output and the readvar answers ntpd gives for the same peers
+NTPQ_OUTPUT = """     remote           refid      st t when poll reach   delay   offset  jitter
+==============================================================================
+*192.0.2.10      .GPS.            1 u   33   64  377    0.462   -0.012   0.018
++198.51.100.7    192.0.2.10       2 u  46m 1024  377    1.204    0.331   0.052
+-203.0.113.5     192.0.2.10       2 u    5   64    7   12.001  -40.215   3.100
+ 127.127.1.0     .LOCL.          10 l    -   64    0    0.000    0.000   0.000
+ 0.opnsense.pool .POOL.          16 p    -   64    0    0.000    0.000   0.000
+"""
+
+PEERS = [
+    (0x9614,{"srcadr": "192.0.2.10","refid": "GPS","stratum": "1","hmode": "3","hpoll": "6","ppoll": "6","reach": "0xff","rec": "0x{0:08x}.00000000".format(NOW - 33 + NTP_EPOCH),"delay": "0.462","offset": "-0.012","jitter": "0.018"}),
+    (0x9414,{"srcadr": "198.51.100.7","refid": "192.0.2.10","stratum": "2","hmode": "3","hpoll": "10","ppoll": "10","reach": "0xff","rec": "0x{0:08x}.00000000".format(NOW - 2768 + NTP_EPOCH),"delay": "1.204","offset": "0.331","jitter": "0.052"}),
+    (0x9314,{"srcadr": "203.0.113.5","refid": "192.0.2.10","stratum": "2","hmode": "3","hpoll": "6","ppoll": "6","reach": "0x7","rec": "0x{0:08x}.00000000".format(NOW - 5 + NTP_EPOCH),"delay": "12.001","offset": "-40.215","jitter": "3.100"}),
+    (0x8011,{"srcadr": "127.127.1.0","refid": "LOCL","stratum": "10","hmode": "3","hpoll": "6","ppoll": "6","reach": "0x0","rec": "0x00000000.00000000","delay": "0.000","offset": "0.000","jitter": "0.000"}),
+    (0x8011,{"srcadr": "0.opnsense.pool","refid": "POOL","stratum": "16","hmode": "3","hpoll": "6","ppoll": "6","reach": "0x0","rec": "0x00000000.00000000","delay": "0.000","offset": "0.000","jitter": "0.000"}),
+]
+
+def ntpq_lines(output):
+    ## parsing of the former check_ntp
+    return ["{0} {1}".format(_line[0],_line[1:]) for _line in output.split("\n")[2:] if _line.strip()]
+
+class mode6_server(object):
+    ## ntpd stub, replies in fragments of fragmentsize bytes in the given order
+    def __init__(self,peers,fragmentsize=16,order=reversed):
+        self._peers = peers
+        self._fragmentsize = fragmentsize
+        self._order = order
+        self._sock = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+        self._sock.bind(("127.0.0.1",0))
+        self.address = self._sock.getsockname()
+        threading.Thread(target=self._serve,daemon=True).start()
+
+    def _payload(self,opcode,associd):
+        if opcode == agent.ntp_control.READSTAT:
+            return b"".join(map(lambda x: struct.pack("!HH",x[0] + 1,x[1][0]),enumerate(self._peers)))
+        return ", ".join(map(lambda x: "{0}={1}".format(*x),self._peers[associd - 1][1].items())).encode("ascii")
+
+    def _serve(self):
+        while True:
+            _data, _remote = self._sock.recvfrom(1024)
+            _, _opcode, _sequence, _, _associd, _, _ = struct.unpack_from("!BBHHHHH",_data)
+            _payload = self._payload(_opcode,_associd)
+            ## stale answer to an earlier request first, the client has to skip it
+            self._sock.sendto(struct.pack("!BBHHHHH",0x16,0x80 | _opcode,(_sequence - 1) & 0xffff,0,_associd,0,4) + b"XXXX",_remote)
+            _fragments = []
+            for _offset in range(0,len(_payload),self._fragmentsize):
+                _fragment = _payload[_offset:_offset + self._fragmentsize]
+                _more = 0x20 if _offset + self._fragmentsize < len(_payload) else 0
+                _fragments.append(struct.pack("!BBHHHHH",0x16,0x80 | _more | _opcode,_sequence,0,_associd,_offset,len(_fragment)) + _fragment)
+            for _fragment in self._order(_fragments):
+                self._sock.sendto(_fragment,_remote)
+
+class test_ntp_control(unittest.TestCase):
+    def test_fragment_reassembly(self):
+        _server = mode6_server(PEERS,fragmentsize=12)
+        with agent.ntp_control(_server.address,timeout=5) as _ntp:
+            self.assertEqual(_ntp.peers(),list(map(lambda x: (x[0] + 1,x[1][0]),enumerate(PEERS))))
+            for _associd,(_status,_vars) in enumerate(PEERS,1):
+                self.assertEqual(_ntp.peervars(_associd),_vars)
+
+    def test_deadline(self):
+        _sock = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+        _sock.bind(("127.0.0.1",0)) ## never answers
+        try:
+            _start = time.monotonic()
+            with agent.ntp_control(_sock.getsockname(),timeout=0.3) as _ntp:
+                with self.assertRaises(OSError):
+                    _ntp.peers()
+            self.assertLess(time.monotonic() - _start,2)
+        finally:
+            _sock.close()
+
+class test_ntp_peerline(unittest.TestCase):
+    def test_matches_ntpq(self):
+        _checker = agent.checkmk_checker.__new__(agent.checkmk_checker)
+        _lines = list(map(lambda x: _checker._ntp_peerline(x[0],x[1],NOW),PEERS))
+        ## the checkmk ntp plugin splits on whitespace
+        self.assertEqual(list(map(str.split,_lines)),list(map(str.split,ntpq_lines(NTPQ_OUTPUT))))
+
+    def test_interval(self):
+        self.assertEqual(list(map(agent.checkmk_checker._ntp_interval,(0,33,2048,2049,18000,18060,345600,349200))),["-","33","2048","34m","300m","5h","96h","4d"])
+
+if __name__ == "__main__":
+    unittest.main()
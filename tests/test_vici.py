@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=utf-8:noet
+
+## vici_session against a fake charon.vici unix socket
+## python3 -m unittest discover tests
+
+import os
+import sys
+import socket
+import struct
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),".."))
+import opnsense_checkmk_agent as agent
+
+vici = agent.vici_session
+
+def element(elementtype,name=None,value=None):
+    _ret = bytes([elementtype])
+    if name is not None:
+        _ret += bytes([len(name)]) + name.encode("utf-8")
+    if value is not None:
+        _ret += struct.pack("!H",len(value)) + value.encode("utf-8")
+    return _ret
+
+def packet(packettype,name=None,message=b""):
+    _data = bytes([packettype])
+    if name is not None:
+        _data += bytes([len(name)]) + name.encode("utf-8")
+    return struct.pack("!I",len(_data) + len(message)) + _data + message
+
+SA_MESSAGE = b"".join([
+    element(vici.SECTION_START,"con1"),
+    element(vici.KEY_VALUE,"uniqueid","7"),
+    element(vici.KEY_VALUE,"state","ESTABLISHED"),
+    element(vici.LIST_START,"local-vips"),
+    element(vici.LIST_ITEM,value="10.0.0.1"),
+    element(vici.LIST_ITEM,value="fd00::1"),
+    element(vici.LIST_END),
+    element(vici.SECTION_START,"child-sas"),
+    element(vici.SECTION_START,"con1-3"),
+    element(vici.KEY_VALUE,"bytes-in","1024"),
+    element(vici.LIST_START,"local-ts"),
+    element(vici.LIST_ITEM,value="10.0.0.0/24"),
+    element(vici.LIST_END),
+    element(vici.SECTION_END),
+    element(vici.SECTION_END),
+    element(vici.KEY_VALUE,"remote-host","198.51.100.1"),
+    element(vici.SECTION_END)
+])
+
+class vici_server(object):
+    ## answers every request with the given packets, records what the client sent
+    def __init__(self,path,replies):
+        self.received = []
+        self._replies = replies
+        self._server = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        self._server.bind(path)
+        self._server.listen(1)
+        self._thread = threading.Thread(target=self._serve,daemon=True)
+        self._thread.start()
+
+    def _serve(self):
+        _conn, _ = self._server.accept()
+        with _conn:
+            _reader = _conn.makefile("rb")
+            for _reply in self._replies:
+                _header = _reader.read(4)
+                if len(_header) < 4:
+                    break
+                _data = _reader.read(struct.unpack("!I",_header)[0])
+                _name = _data[2:2 + _data[1]].decode("utf-8") if len(_data) > 1 else None
+                self.received.append((_data[0],_name))
+                _conn.sendall(_reply)
+        self._server.close()
+
+class test_vici_decode(unittest.TestCase):
+    def test_nested_sections_and_lists(self):
+        self.assertEqual(vici.decode(SA_MESSAGE),{
+            "con1": {
+                "uniqueid": "7",
+                "state": "ESTABLISHED",
+                "local-vips": ["10.0.0.1","fd00::1"],
+                "child-sas": {"con1-3": {"bytes-in": "1024","local-ts": ["10.0.0.0/24"]}},
+                "remote-host": "198.51.100.1"
+            }
+        })
+
+    def test_empty_message(self):
+        self.assertEqual(vici.decode(b""),{})
+
+    def test_invalid_element(self):
+        with self.assertRaises(ValueError):
+            vici.decode(bytes([9,1]) + b"x")
+
+class test_vici_session(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+        self._path = os.path.join(self._directory,"charon.vici")
+
+    def tearDown(self):
+        if os.path.exists(self._path):
+            os.unlink(self._path)
+        os.rmdir(self._directory)
+
+    def test_streamed_request(self):
+        _server = vici_server(self._path,[
+            packet(vici.EVENT_CONFIRM),
+            packet(vici.EVENT,"list-sa",SA_MESSAGE) + packet(vici.EVENT,"list-sa",element(vici.SECTION_START,"con2") + element(vici.SECTION_END)) + packet(vici.CMD_RESPONSE),
+            packet(vici.EVENT_CONFIRM)
+        ])
+        with vici(path=self._path,timeout=5) as _vici:
+            _sas = list(_vici.streamed_request("list-sas","list-sa"))
+        self.assertEqual(list(map(lambda x: list(x.keys()),_sas)),[["con1"],["con2"]])
+        self.assertEqual(_sas[0]["con1"]["child-sas"]["con1-3"]["bytes-in"],"1024")
+        _server._thread.join(5)
+        self.assertEqual(_server.received,[(vici.EVENT_REGISTER,"list-sa"),(vici.CMD_REQUEST,"list-sas"),(vici.EVENT_UNREGISTER,"list-sa")])
+
+    def test_event_not_confirmed(self):
+        vici_server(self._path,[packet(vici.EVENT_UNKNOWN)])
+        with vici(path=self._path,timeout=5) as _vici:
+            with self.assertRaises(ConnectionError):
+                list(_vici.streamed_request("list-sas","list-sa"))
+
+    def test_command_unknown(self):
+        _server = vici_server(self._path,[packet(vici.EVENT_CONFIRM),packet(vici.CMD_UNKNOWN),packet(vici.EVENT_CONFIRM)])
+        with vici(path=self._path,timeout=5) as _vici:
+            with self.assertRaises(ConnectionError):
+                list(_vici.streamed_request("list-nothing","list-sa"))
+        _server._thread.join(5)
+        self.assertEqual(_server.received[-1],(vici.EVENT_UNREGISTER,"list-sa")) ## unregistered after the failure
+
+if __name__ == "__main__":
+    unittest.main()